@@ -0,0 +1,179 @@
+"""
+Generates synthetic Segment events as NDJSON or NDJSON.gz, with a configurable mix of event types,
+property width, nesting depth and rate of values whose type conflicts with the rest of their column.
+
+Run with: python -m benchmarks.event_generator --events 100000 --output /tmp/events.json.gz
+"""
+import argparse
+import gzip
+import json
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict
+
+DEFAULT_MIX = "track=70,identify=10,page=10,screen=10"
+EVENT_TYPES = ["track", "identify", "page", "screen", "group", "alias"]
+PROPERTY_KINDS = ["string", "integer", "float", "boolean"]
+# Nested properties are spread over this many objects at each level
+NESTED_GROUPS = 3
+START_TIME = datetime(2021, 1, 1)
+
+
+@dataclass()
+class EventShape:
+    """Shape of generated events"""
+
+    mix: Dict[str, float] = field(default_factory=lambda: parse_mix(DEFAULT_MIX))
+    properties: int = 20
+    depth: int = 1
+    conflict_rate: float = 0.0
+    event_names: int = 10
+    users: int = 1000
+
+
+def parse_mix(mix: str):
+    """Parses weights of event types like track=70,identify=10"""
+    weights = {}
+    for part in mix.split(","):
+        event_type, _, weight = part.partition("=")
+        event_type = event_type.strip()
+        if event_type not in EVENT_TYPES:
+            raise Exception(f"Unknown event type {event_type} in mix {mix}, expected one of {EVENT_TYPES}")
+        weights[event_type] = float(weight or 1)
+    return weights
+
+
+class EventGenerator:
+    """
+    Generates events of a shape. Property i of every event has the same kind and path, so columns have a
+    stable type, except for conflict_rate of values which are generated with another type.
+    Half of conflicting values can be cast back to the type of their column, the rest end up as misfits.
+    Booleans only conflict with 0 and 1, as other values can not be inserted into their UInt8 columns.
+    """
+
+    def __init__(self, shape: EventShape, seed: int = 42):
+        self.shape = shape
+        self.random = random.Random(seed)
+        self.event_types = list(shape.mix)
+        self.weights = list(shape.mix.values())
+        self.event_names = [f"Event Name {i}" for i in range(shape.event_names)]
+        self.property_paths = [self.property_path(i) for i in range(shape.properties)]
+
+    def property_path(self, i):
+        path = [f"group{(i + level) % NESTED_GROUPS}" for level in range(self.shape.depth - 1)]
+        return path + [f"prop{i}{PROPERTY_KINDS[i % len(PROPERTY_KINDS)].title()}"]
+
+    def events(self, count: int):
+        for i in range(count):
+            yield self.event(i)
+
+    def event(self, i: int):
+        rnd = self.random
+        event_type = rnd.choices(self.event_types, self.weights)[0]
+        ts = (START_TIME + timedelta(milliseconds=i)).isoformat() + "Z"
+        event = {
+            "type": event_type,
+            "messageId": f"msg-{rnd.getrandbits(64):016x}",
+            "anonymousId": f"anon-{rnd.randrange(self.shape.users)}",
+            "userId": f"user-{rnd.randrange(self.shape.users)}",
+            "receivedAt": ts,
+            "sentAt": ts,
+            "timestamp": ts,
+            "channel": "client",
+            "writeKey": "write-key",
+            "context": {
+                "app": {"name": "Example", "version": "1.2.3"},
+                "library": {"name": "analytics-android", "version": "4.9.0"},
+                "os": {"name": rnd.choice(["Android", "iOS"]), "version": "11"},
+                "ip": f"10.0.{rnd.randrange(256)}.{rnd.randrange(256)}",
+            },
+        }
+        if event_type == "track":
+            event["event"] = rnd.choice(self.event_names)
+            event["properties"] = self.properties()
+        elif event_type == "identify":
+            event["traits"] = self.properties()
+        elif event_type in ("page", "screen"):
+            event["name"] = rnd.choice(self.event_names)
+            event["properties"] = self.properties()
+        elif event_type == "group":
+            event["groupId"] = f"group-{rnd.randrange(100)}"
+            event["traits"] = self.properties()
+        else:
+            event["previousId"] = f"anon-{rnd.randrange(self.shape.users)}"
+        return event
+
+    def properties(self):
+        properties = {}
+        for i, path in enumerate(self.property_paths):
+            parent = properties
+            for key in path[:-1]:
+                parent = parent.setdefault(key, {})
+            parent[path[-1]] = self.value(PROPERTY_KINDS[i % len(PROPERTY_KINDS)])
+        return properties
+
+    def value(self, kind):
+        rnd = self.random
+        conflict = rnd.random() < self.shape.conflict_rate
+        castable = rnd.random() < 0.5
+        if kind == "string":
+            if conflict:
+                return rnd.randrange(1000) if castable else rnd.random() > 0.5
+            return rnd.choice(["red", "green", "blue", "a somewhat longer value of a string property"])
+        if kind == "integer":
+            value = rnd.randrange(100000)
+            if conflict:
+                return str(value) if castable else "n/a"
+            return value
+        if kind == "float":
+            value = round(rnd.random() * 1000, 2)
+            if conflict:
+                return str(value) if castable else "unknown"
+            return value
+        if conflict:
+            return int(rnd.random() > 0.5)
+        return rnd.random() > 0.5
+
+
+def write_events(file_path: str, events):
+    """Writes events as NDJSON, gzipped if file_path ends with .gz. Returns count of events."""
+    opener = gzip.open if file_path.endswith(".gz") else open
+    count = 0
+    with opener(file_path, "wt") as f:
+        for event in events:
+            f.write(json.dumps(event))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def add_shape_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weights of event types")
+    parser.add_argument("--properties", type=int, default=20, help="Properties or traits per event")
+    parser.add_argument("--depth", type=int, default=1, help="Nesting depth of properties")
+    parser.add_argument("--conflict-rate", type=float, default=0.0,
+                        help="Share of property values with a type conflicting with their column")
+    parser.add_argument("--seed", type=int, default=42)
+
+
+def shape_from_args(args):
+    return EventShape(
+        mix=parse_mix(args.mix), properties=args.properties, depth=max(args.depth, 1),
+        conflict_rate=args.conflict_rate,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_shape_arguments(parser)
+    parser.add_argument("--output", required=True, help="File to write, gzipped if it ends with .gz")
+    args = parser.parse_args()
+
+    count = write_events(args.output, EventGenerator(shape_from_args(args), args.seed).events(args.events))
+    print(f"Wrote {count} events to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
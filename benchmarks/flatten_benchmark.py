@@ -0,0 +1,79 @@
+"""
+Compares two-pass humps.decamelize + json_util.flatten_json with single pass json_util.flatten_event,
+and with flatten_event keeping lists as arrays. Columns are distinct columns of all flattened events.
+
+Run with: python -m benchmarks.flatten_benchmark --events 100000 --items 50
+"""
+import argparse
+import json
+import random
+import timeit
+
+import humps
+
+from seghouse.util import json_util
+
+
+def sample_event(rnd: random.Random, items: int = 3):
+    return {
+        "type": "track",
+        "messageId": f"msg-{rnd.getrandbits(64)}",
+        "anonymousId": f"anon-{rnd.randint(1, 1000)}",
+        "event": rnd.choice(["Order Completed", "Product Viewed", "Cart Updated"]),
+        "receivedAt": "2021-01-01T00:00:00.000Z",
+        "timestamp": "2021-01-01T00:00:00.000Z",
+        "context": {
+            "app": {"name": "Example", "version": "1.2.3", "build": "123"},
+            "device": {"id": "device-id", "manufacturer": "Google", "model": "Pixel 5"},
+            "library": {"name": "analytics-android", "version": "4.9.0"},
+            "os": {"name": "Android", "version": "11"},
+            "screen": {"density": 2.75, "height": 2200, "width": 1080},
+            "network": {"carrier": "Example", "wifi": rnd.random() > 0.5},
+            "userAgent": "Dalvik/2.1.0",
+        },
+        "properties": {
+            "orderId": f"order-{rnd.randint(1, 10000)}",
+            "revenue": rnd.random() * 100,
+            "productList": [
+                {"productId": i, "productSKU": f"sku-{i}", "unitPrice": 1.5} for i in range(rnd.randint(1, items))
+            ],
+            "Coupon Code": "ABC-10",
+        },
+    }
+
+
+def two_pass(events):
+    return [json_util.flatten_json(humps.decamelize(e)) for e in events]
+
+
+def single_pass(events):
+    return [json_util.flatten_event(e) for e in events]
+
+
+def arrays(events):
+    return [json_util.flatten_event(e, arrays=True) for e in events]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--items", type=int, default=3, help="Most items in product list of an event")
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    # Decode from json so that each run gets fresh objects like NDJSON ingestion does
+    lines = [json.dumps(sample_event(rnd, args.items)) for _ in range(args.events)]
+    events = [json.loads(line) for line in lines]
+
+    assert two_pass(events[:100]) == single_pass(events[:100])
+
+    for name, fn in (("two_pass", two_pass), ("single_pass", single_pass), ("arrays", arrays)):
+        best = min(timeit.repeat(lambda: fn(events), number=1, repeat=args.repeat))
+        columns = len(set().union(*fn(events)))
+        print(f"{name:12} {best:8.3f}s {args.events / best:12.0f} events/sec {columns:8} columns")
+    print(f"key cache = {json_util.child_column_name.cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
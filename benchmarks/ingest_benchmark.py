@@ -0,0 +1,185 @@
+"""
+Times each stage of ingest on a synthetic Segment NDJSON.gz file and reports rows/sec and peak memory per stage.
+Rows are inserted into an in-memory ClickHouse, see benchmarks.memory_warehouse.
+Tables get column types of a conflict-free sample of events, so that conflicting values are cast or become misfits.
+
+Run with: python -m benchmarks.ingest_benchmark --events 100000 --properties 50 --depth 2 --conflict-rate 0.01
+"""
+import argparse
+import dataclasses
+import gzip
+import os
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable
+
+from tabulate import tabulate
+
+from benchmarks.event_generator import EventGenerator, add_shape_arguments, shape_from_args, write_events
+from benchmarks.memory_warehouse import InMemoryClickHouse
+from seghouse.config import default_table_structure, event_fields
+from seghouse.config.data_type import DataType
+from seghouse.jobs.send_to_warehouse import SendToWarehouseJob
+from seghouse.util import dataframe_util, json_util
+
+SCHEMA = "benchmark"
+SAMPLE_EVENTS = 5000
+NON_NULL_COLUMNS = [event_fields.RECEIVED_AT, event_fields.TIMESTAMP, event_fields.MESSAGE_ID]
+# Attribute of EventDataFrames -> table and its default structure
+TYPE_TABLES = {
+    "tracks": (default_table_structure.TRACKS_TABLE, default_table_structure.TRACKS),
+    "identities": (default_table_structure.IDENTITIES_TABLE, default_table_structure.IDENTITIES),
+    "pages": (default_table_structure.PAGES_TABLE, default_table_structure.PAGES),
+    "screens": (default_table_structure.SCREENS_TABLE, default_table_structure.SCREENS),
+    "groups": (default_table_structure.GROUPS_TABLE, default_table_structure.GROUPS),
+    "aliases": (default_table_structure.ALIASES_TABLE, default_table_structure.ALIASES),
+}
+
+
+@dataclass()
+class Stage:
+    """Stage of ingest. prepare builds fresh arguments of run, outside of timing."""
+
+    name: str
+    prepare: Callable[[], tuple]
+    run: Callable
+
+
+def type_frames(df):
+    """Non empty data frames per event type, as process_df gets them"""
+    event_data_frames = SendToWarehouseJob.break_down_by_type(df)
+    event_data_frames.set_extra_timestamps({})
+    return {
+        attr: getattr(event_data_frames, attr)
+        for attr in TYPE_TABLES if not dataframe_util.empty(getattr(event_data_frames, attr))
+    }
+
+
+def table_types(generator):
+    """Column types of every type table, inferred from events without type conflicts"""
+    events = generator.events(SAMPLE_EVENTS)
+    df = SendToWarehouseJob.to_df([json_util.flatten_event(e) for e in events])
+    return {attr: dataframe_util.get_datatypes(frame) for attr, frame in type_frames(df).items()}
+
+
+def create_tables(warehouse, types):
+    warehouse.create_schema(SCHEMA)
+    for attr, col_types in types.items():
+        table, default_structure = TYPE_TABLES[attr]
+        warehouse.create_table(SCHEMA, table, default_structure, NON_NULL_COLUMNS)
+        existing = warehouse.describe_table(SCHEMA, table)
+        warehouse.add_columns(
+            SCHEMA, table, {c: t for c, t in col_types.items() if c not in existing}, NON_NULL_COLUMNS
+        )
+
+
+def read_events(file_path):
+    with gzip.open(file_path, "rb") as f:
+        return json_util.loads_lines(f.readlines())
+
+
+def copies(frames):
+    return {attr: frame.copy() for attr, frame in frames.items()}
+
+
+def typed_frames(frames):
+    """Frames with their column types, as store_* hands them to warehouses"""
+    return {attr: dataframe_util.TypedFrame.infer(dataframe_util.mark_nan_to_none(frame.copy()))
+            for attr, frame in frames.items()}
+
+
+def cast_frames(frames):
+    """Copies of typed frames with column types as cast_to_table passes them to fix_data_types"""
+    cast = {}
+    for attr, frame in frames.items():
+        df = frame.df.copy()
+        dataframe_util.cast_boolean_to_int(df, frame.col_types)
+        col_types = {c: DataType.INT64 if t == DataType.BOOLEAN else t for c, t in frame.col_types.items()}
+        cast[attr] = dataframe_util.TypedFrame(df, col_types)
+    return cast
+
+
+def get_datatypes(frames):
+    for frame in frames.values():
+        dataframe_util.get_datatypes(frame)
+
+
+def fix_data_types(warehouse, frames):
+    for attr, frame in frames.items():
+        dataframe_util.fix_data_types(
+            frame.df, warehouse.describe_table(SCHEMA, TYPE_TABLES[attr][0]), frame.col_types
+        )
+
+
+def insert_df(warehouse, frames):
+    for attr, frame in frames.items():
+        warehouse.insert_df(SCHEMA, TYPE_TABLES[attr][0], frame.df, frame.col_types)
+
+
+def best_time(stage: Stage, repeat: int):
+    best = None
+    for _ in range(repeat):
+        args = stage.prepare()
+        start = time.perf_counter()
+        stage.run(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(stage: Stage):
+    """Peak bytes allocated while stage runs. Measured in a run of its own, as tracing slows down stages."""
+    args = stage.prepare()
+    tracemalloc.start()
+    try:
+        stage.run(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_shape_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    shape = shape_from_args(args)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "events.json.gz")
+        write_events(file_path, EventGenerator(shape, args.seed).events(args.events))
+        file_size = os.path.getsize(file_path)
+
+        events = read_events(file_path)
+        df = SendToWarehouseJob.get_file_df(file_path)
+        frames = type_frames(df)
+        marked_frames = typed_frames(frames)
+        warehouse = InMemoryClickHouse()
+        create_tables(warehouse, table_types(EventGenerator(dataclasses.replace(shape, conflict_rate=0.0), args.seed)))
+
+        stages = [
+            Stage("get_file_df", lambda: (file_path,), SendToWarehouseJob.get_file_df),
+            Stage("flatten_event", lambda: (events,), lambda e: [json_util.flatten_event(x) for x in e]),
+            Stage("break_down_by_type", lambda: (df,), type_frames),
+            Stage("get_datatypes", lambda: (copies(frames),), get_datatypes),
+            Stage("fix_data_types", lambda: (warehouse, cast_frames(marked_frames)), fix_data_types),
+            Stage("insert_df", lambda: (warehouse, marked_frames), insert_df),
+        ]
+        rows = []
+        for stage in stages:
+            seconds = best_time(stage, args.repeat)
+            peak_mb = round(peak_memory(stage) / 2 ** 20, 1)
+            rows.append((stage.name, round(seconds, 3), int(args.events / seconds), peak_mb))
+
+    print(f"events = {args.events}, file = {file_size} bytes, columns = {len(df.columns)}, "
+          f"properties = {shape.properties}, depth = {shape.depth}, conflict rate = {shape.conflict_rate}")
+    print(tabulate(rows, headers=["stage", "seconds", "rows/sec", "peak MB"]))
+    inserted = sorted((table, count // (args.repeat + 1)) for table, count in warehouse.rows.items())
+    print(tabulate(inserted, headers=["table", "rows per run"]))
+    warehouse.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Compares line by line stdlib json decoding of NDJSON with bulk decoding of whole buffers by json_util backends.
+
+Run with: python -m benchmarks.json_benchmark --events 100000
+"""
+import argparse
+import gzip
+import io
+import json
+import random
+import timeit
+
+from benchmarks.flatten_benchmark import sample_event
+from seghouse.jobs.send_to_warehouse import DECODE_BUFFER_SIZE
+from seghouse.util import json_util
+
+
+def per_line(data, loads):
+    with gzip.open(io.BytesIO(data), "rb") as f:
+        return [loads(line) for line in f]
+
+
+def bulk(data, loads):
+    events = []
+    with gzip.open(io.BytesIO(data), "rb") as f:
+        for lines in iter(lambda: f.readlines(DECODE_BUFFER_SIZE), []):
+            events.extend(json_util.loads_lines(lines, loads))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    ndjson = "".join(json.dumps(sample_event(rnd)) + "\n" for _ in range(args.events))
+    data = gzip.compress(ndjson.encode())
+
+    runs = [("json per line", per_line, json.loads), ("json bulk", bulk, json.loads)]
+    for backend in json_util.FAST_JSON_BACKENDS:
+        try:
+            runs.append((f"{backend} bulk", bulk, json_util.get_loads(backend)))
+        except Exception as e:
+            print(f"Skipping {backend}: {e}")
+
+    expected = per_line(data, json.loads)
+    for name, fn, loads in runs:
+        assert fn(data, loads) == expected
+        best = min(timeit.repeat(lambda: fn(data, loads), number=1, repeat=args.repeat))
+        print(f"{name:14} {best:8.3f}s {args.events / best:12.0f} events/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+ClickHouse warehouse answering its queries from memory, so that benchmarks time conversion of data frames
+by ClickHouse.insert_df without a server. Sending rows over network is not included.
+"""
+import re
+from collections import Counter
+from typing import Dict
+
+from seghouse.warehouse.clickhouse import ClickHouse, SAMPLE_QUERY
+
+CREATE_DATABASE = re.compile(r"CREATE DATABASE IF NOT EXISTS (\S+)")
+CREATE_TABLE = re.compile(r"CREATE TABLE IF NOT EXISTS (\S+) \((.*)\) ENGINE")
+ALTER_TABLE = re.compile(r"ALTER TABLE (\S+) (.*)")
+ADD_COLUMN = "ADD COLUMN IF NOT EXISTS "
+DESCRIBE_TABLE = re.compile(r"DESCRIBE TABLE (\S+)")
+INSERT = re.compile(r"INSERT INTO (\S+)")
+
+
+class InMemoryClickHouse(ClickHouse):
+    """Keeps columns of created tables and counts inserted rows per table. Rows themselves are dropped."""
+
+    tables: Dict[str, Dict[str, str]]
+    rows: Counter
+
+    def __init__(self, conf_dict: dict = None):
+        self.tables = {}
+        self.rows = Counter()
+        super().__init__(conf_dict or {"type": "clickhouse", "host": "memory", "user": "", "password": ""})
+
+    def execute(self, query, params=None, **kwargs):
+        query = " ".join(query.split())
+        if query == SAMPLE_QUERY:
+            return [(1,)]
+        if CREATE_DATABASE.match(query):
+            return []
+
+        match = CREATE_TABLE.match(query)
+        if match:
+            columns = self.tables.setdefault(match.group(1), {})
+            for column_def in split_top_level(match.group(2)):
+                name, column_type = column_def.split(" ", 1)
+                columns.setdefault(name, column_type)
+            return []
+
+        match = ALTER_TABLE.match(query)
+        if match:
+            columns = self.tables[match.group(1)]
+            for clause in split_top_level(match.group(2)):
+                name, column_type = clause[len(ADD_COLUMN):].split(" ", 1)
+                columns.setdefault(name, column_type)
+            return []
+
+        match = DESCRIBE_TABLE.match(query)
+        if match:
+            return list(self.tables[match.group(1)].items())
+
+        match = INSERT.match(query)
+        if match:
+            rows = len(params[0]) if params and kwargs.get("columnar") else len(params or [])
+            self.rows[match.group(1)] += rows
+            return rows
+
+        raise Exception(f"Query is not supported by in-memory ClickHouse: {query}")
+
+
+def split_top_level(text: str):
+    """Splits comma separated parts of text, ignoring commas within parentheses like in Map(String, String)"""
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(text):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            parts.append(text[start:i].strip())
+            start = i + 1
+    parts.append(text[start:].strip())
+    return [p for p in parts if p]
@@ -1,12 +1,12 @@
+import dataclasses
 import logging.config
-import shutil
 from os import path
 
 import click
 
 from .config import configuration
 from .jobs import send_to_warehouse
-from .util import aws_wrapper
+from .util import file_source, json_util
 
 log_file_path = path.join(path.dirname(path.abspath(__file__)), 'logging.conf')
 logging.config.fileConfig(log_file_path)
@@ -24,21 +24,50 @@ def app():
               help="S3 Directory. We will look for *.gz files in this directory. "
                    "Ensure that you have configured aws "
                    "credentials using aws cli. "
-                   "Make sure that this directory contains files less than 100.")
+                   "Files are downloaded one by one while they are ingested, see --prefetch, "
+                   "so the directory may hold any number of files.")
 @click.option("--source-dir", "-sd", type=click.Path(exists=True))
 @click.option("--namespace", "-ns", required=True, help="Will be used to create database/namespace in warehouse", )
-def send(config_file: str, s3_dir: str, source_dir: str, namespace: str):
+@click.option("--s3-endpoint-url", help="Custom S3 endpoint, e.g. a local S3 stand-in like MinIO")
+@click.option("--workers", "-w", type=click.IntRange(min=1), default=1, show_default=True,
+              help="Number of worker processes. Files are spread over workers.")
+@click.option("--prefetch", type=click.IntRange(min=0), default=2, show_default=True,
+              help="Number of files fetched ahead of the files being processed. "
+                   "Fetched S3 files are deleted once they are ingested.")
+@click.option("--json-backend", type=click.Choice(json_util.JSON_BACKENDS),
+              help="JSON decoder. Overrides json_backend of config file.")
+@click.option("--metrics-file", type=click.Path(dir_okay=False),
+              help="File to write metrics of job to, in Prometheus text format if it ends with .prom "
+                   "and as JSON otherwise. Overrides metrics_file of config file.")
+@click.option("--profile", "profile_dir", type=click.Path(file_okay=False),
+              help="Directory to write CPU profiles of processed files to, in a subdirectory per run. "
+                   "A summary of hot functions is logged at the end of the run.")
+@click.option("--profile-rate", type=click.FloatRange(min=0, max=1), default=1.0, show_default=True,
+              help="Share of files to profile, e.g. 0.05 to profile one in twenty files.")
+@click.option("--profile-memory", is_flag=True,
+              help="Also trace memory allocations made while a profiled file is processed. Slows down processing.")
+def send(config_file: str, s3_dir: str, source_dir: str, namespace: str, s3_endpoint_url: str, workers: int,
+         prefetch: int, json_backend: str, metrics_file: str, profile_dir: str, profile_rate: float,
+         profile_memory: bool):
     """Send Segment Files to different warehouses """
     logger.info(f"config_file={config_file}")
     app_conf = configuration.from_yaml(config_file)
+    if json_backend:
+        app_conf = dataclasses.replace(app_conf, json_backend=json_backend)
+    if metrics_file:
+        app_conf = dataclasses.replace(app_conf, metrics_file=metrics_file)
+    if profile_dir:
+        app_conf = dataclasses.replace(
+            app_conf, profile_dir=profile_dir, profile_rate=profile_rate, profile_memory=profile_memory
+        )
 
-    try:
-        if s3_dir:
-            source_dir = aws_wrapper.download_gz_files(s3_dir)
+    if s3_dir:
+        source = file_source.S3Source(s3_dir, s3_endpoint_url)
+    else:
+        source = file_source.LocalDirSource(source_dir)
 
-        job = send_to_warehouse.SendToWarehouseJob(app_conf, source_dir, namespace)
+    try:
+        job = send_to_warehouse.SendToWarehouseJob(app_conf, source, namespace, workers, prefetch, log_file_path)
         job.execute()
     finally:
-        if s3_dir:
-            logger.info(f"Removing directory {source_dir}")
-            shutil.rmtree(source_dir)
\ No newline at end of file
+        source.close()
\ No newline at end of file
@@ -1,9 +1,11 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Tuple
 
 import humps
 import yaml
 
+from . import default_table_structure
+
 
 @dataclass(frozen=True, eq=True)
 class App:
@@ -19,6 +21,38 @@ class App:
 yaml.add_path_resolver("!app", ["App"], dict)
 
 
+@dataclass(frozen=True, eq=True)
+class MapColumns:
+    """
+    Columns of a table which are packed into a Map(String, String) column per prefix instead of being columns
+    of their own. Map column is named after prefix without its trailing _, e.g. context_os_name is key os_name
+    of column context. Hot columns stay columns of their own.
+    """
+
+    prefixes: Tuple[str, ...] = default_table_structure.TRACKS_ALLOWED_FIELD_PREFIXES
+    hot_columns: FrozenSet[str] = frozenset()
+
+    def map_column(self, prefix: str):
+        return prefix.rstrip("_")
+
+
+@dataclass(frozen=True, eq=True)
+class LowCardinality:
+    """
+    String columns which are created as LowCardinality(Nullable(String)). Listed columns always are and excluded
+    columns never are. Other string columns are when, in batch which creates them, distinct values are at most
+    max_ratio of at least min_values values and at most max_distinct. 0 max_ratio turns off detection.
+    Counts are not kept across batches, as a column is created by first batch holding it.
+    """
+
+    columns: FrozenSet[str] = frozenset()
+    excluded_columns: FrozenSet[str] = frozenset()
+    max_ratio: float = 0.0
+    min_values: int = 1000
+    # Dictionaries of LowCardinality columns stop paying off beyond about 10000 distinct values
+    max_distinct: int = 10000
+
+
 @dataclass(frozen=True, eq=True)
 class AppConf:
     """Top level configuration class"""
@@ -27,6 +61,23 @@ class AppConf:
     warehouses: List[dict]
     skip_fields: List[str]
     extra_timestamps: dict
+    batch_rows: int = 0
+    batch_bytes: int = 0
+    manifest_file: str = None
+    flush_rows: int = 0
+    flush_bytes: int = 0
+    flush_seconds: float = 0
+    json_backend: str = "auto"
+    pipeline_queue_size: int = 2
+    max_memory_mb: int = 0
+    metrics_file: str = None
+    profile_dir: str = None
+    profile_rate: float = 1.0
+    profile_memory: bool = False
+    # Table -> columns packed into map columns
+    map_columns: Dict[str, MapColumns] = field(default_factory=dict)
+    array_columns: bool = False
+    low_cardinality: LowCardinality = LowCardinality()
 
 
 def from_yaml(file_path: str):
@@ -39,7 +90,47 @@ def from_yaml(file_path: str):
         for f in resolved_conf.get("skip_fields", []):
             skip_fields.append(f)
         extra_timestamps = resolved_conf.get("extra_timestamps", {})
+        map_columns = {}
+        for table, map_dict in (resolved_conf.get("map_columns") or {}).items():
+            map_columns[table] = to_map_columns(table, map_dict or {})
     return AppConf(
         apps=list(apps), warehouses=resolved_conf["warehouses"], skip_fields=skip_fields,
-        extra_timestamps=extra_timestamps
+        extra_timestamps=extra_timestamps,
+        batch_rows=resolved_conf.get("batch_rows", 0),
+        batch_bytes=resolved_conf.get("batch_bytes", 0),
+        manifest_file=resolved_conf.get("manifest_file"),
+        flush_rows=resolved_conf.get("flush_rows", 0),
+        flush_bytes=resolved_conf.get("flush_bytes", 0),
+        flush_seconds=resolved_conf.get("flush_seconds", 0),
+        json_backend=resolved_conf.get("json_backend", "auto"),
+        pipeline_queue_size=resolved_conf.get("pipeline_queue_size", 2),
+        max_memory_mb=resolved_conf.get("max_memory_mb", 0),
+        metrics_file=resolved_conf.get("metrics_file"),
+        map_columns=map_columns,
+        array_columns=resolved_conf.get("array_columns", False),
+        low_cardinality=to_low_cardinality(resolved_conf.get("low_cardinality") or {}),
+    )
+
+
+def to_map_columns(table: str, map_dict: dict):
+    map_columns = MapColumns(
+        prefixes=tuple(map_dict.get("prefixes", MapColumns.prefixes)),
+        hot_columns=frozenset(map_dict.get("hot_columns", [])),
+    )
+    for prefix in map_columns.prefixes:
+        if not map_columns.map_column(prefix):
+            raise Exception(f"Invalid prefix '{prefix}' in map_columns of table {table}")
+    return map_columns
+
+
+def to_low_cardinality(low_cardinality_dict: dict):
+    low_cardinality = LowCardinality(
+        columns=frozenset(low_cardinality_dict.get("columns", [])),
+        excluded_columns=frozenset(low_cardinality_dict.get("excluded_columns", [])),
+        max_ratio=low_cardinality_dict.get("max_ratio", LowCardinality.max_ratio),
+        min_values=low_cardinality_dict.get("min_values", LowCardinality.min_values),
+        max_distinct=low_cardinality_dict.get("max_distinct", LowCardinality.max_distinct),
     )
+    if not 0 <= low_cardinality.max_ratio <= 1:
+        raise Exception(f"max_ratio of low_cardinality must be between 0 and 1, got {low_cardinality.max_ratio}")
+    return low_cardinality
@@ -22,7 +22,12 @@ class DataType(Enum):
     UUID = "uuid"
     DATE = "date"
     DATETIME = "datetime"
+    # Array of strings, also of values of mixed types
     ARRAY = "array"
+    ARRAY_INT64 = "array_int64"
+    ARRAY_FLOAT64 = "array_double"
+    # Map(String, String) of columns packed by prefix
+    MAP = "map"
 
 
 INT_DATATYPES = (
@@ -40,3 +45,5 @@ INT_DATATYPES = (
 )
 
 FLOAT_DATATYPES = (DataType.FLOAT64, DataType.FLOAT32)
+
+ARRAY_DATATYPES = (DataType.ARRAY, DataType.ARRAY_INT64, DataType.ARRAY_FLOAT64)
@@ -0,0 +1,222 @@
+import logging
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Set
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 0.5
+
+_END = object()
+
+
+class StageStopped(Exception):
+    """Raised in a stage once pipeline is stopped because of an error elsewhere"""
+
+
+class ReadAhead:
+    """
+    Iterates over items of iterable produced by a background thread, at most queue_size items ahead of consumer.
+    Errors of producer are raised in consumer. With queue_size 0 items are produced by consumer thread itself.
+    """
+
+    def __init__(self, iterable: Iterable, queue_size: int, name: str):
+        self.iterable = iterable
+        self.queue_size = queue_size
+        self.name = name
+        self.items = queue.Queue(maxsize=max(queue_size, 1))
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __iter__(self):
+        if not self.queue_size:
+            yield from self.iterable
+            return
+
+        self.thread = threading.Thread(target=self.produce, name=self.name, daemon=True)
+        self.thread.start()
+        while True:
+            item, error = self.items.get()
+            if error is not None:
+                raise error
+            if item is _END:
+                return
+            yield item
+
+    def produce(self):
+        try:
+            for item in self.iterable:
+                self.put((item, None))
+            self.put((_END, None))
+        except StageStopped:
+            pass
+        except BaseException as e:
+            self.items.put((None, e))
+
+    def put(self, item):
+        while True:
+            if self.stopped.is_set():
+                raise StageStopped()
+            try:
+                self.items.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        """Stops producer. Its thread is not waited for, as it may be blocked in iterable."""
+        self.stopped.set()
+
+
+class Stage:
+    """
+    Runs submitted calls one by one in a background thread. At most queue_size calls wait, so submit blocks
+    while stage is behind. First error stops stage and is raised by next submit or close.
+    With queue_size 0 calls run right away in caller thread.
+    after is called once every call is done.
+    """
+
+    def __init__(self, name: str, queue_size: int, after: Callable[[], None] = None):
+        self.name = name
+        self.queue_size = queue_size
+        self.after = after
+        self.calls = queue.Queue(maxsize=max(queue_size, 1))
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = None
+        if queue_size:
+            self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+            self.thread.start()
+
+    def submit(self, fn: Callable, *args):
+        if not self.thread:
+            self.call(fn, args)
+            return
+        self.put((fn, args))
+
+    def put(self, item):
+        while True:
+            self.raise_error()
+            try:
+                self.calls.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                item = self.calls.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is _END:
+                return
+            try:
+                self.call(*item)
+            except BaseException as e:
+                logger.exception(f"{self.name} failed")
+                self.error = e
+                self.stopped.set()
+
+    def call(self, fn, args):
+        fn(*args)
+        if self.after:
+            self.after()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Waits for submitted calls to be done"""
+        if self.thread:
+            self.put(_END)
+            self.thread.join()
+        self.raise_error()
+
+    def abort(self):
+        """Drops submitted calls which are not yet started and returns them as (fn, args)"""
+        self.stopped.set()
+        dropped = []
+        if self.thread:
+            self.thread.join()
+            while not self.calls.empty():
+                item = self.calls.get_nowait()
+                if item is not _END:
+                    dropped.append(item)
+        return dropped
+
+
+@dataclass()
+class Failure:
+    """Call which failed for a target"""
+
+    target: str
+    name: str
+    error: str
+
+
+class FanOut:
+    """
+    Runs calls of every target on its own thread pool, at most limits[target] at a time.
+    Up to as many calls again may wait per target, after which submit blocks.
+    A failed call is recorded as failure of its target while calls of other targets go on.
+    Each call carries the sources of its data, so that callers know which sources are still in flight or failed.
+    """
+
+    def __init__(self, limits: Dict[str, int]):
+        self.executors = {
+            target: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"seghouse-{target}")
+            for target, limit in limits.items()
+        }
+        self.slots = {target: threading.Semaphore(2 * limit) for target, limit in limits.items()}
+        self.lock = threading.Lock()
+        self.futures = set()
+        self.in_flight = Counter()
+        self.failures = []
+        self.failed_sources = set()
+
+    def submit(self, target: str, name: str, sources: Set[str], fn: Callable, *args):
+        self.slots[target].acquire()
+        with self.lock:
+            self.in_flight.update(sources)
+            future = self.executors[target].submit(self.run, target, name, sources, fn, args)
+            self.futures.add(future)
+        future.add_done_callback(self.done)
+
+    def run(self, target, name, sources, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.exception(f"{name} failed for {target}")
+            with self.lock:
+                self.failures.append(Failure(target, name, repr(e)))
+                self.failed_sources.update(sources)
+        finally:
+            with self.lock:
+                for source in sources:
+                    self.in_flight[source] -= 1
+                    if not self.in_flight[source]:
+                        del self.in_flight[source]
+            self.slots[target].release()
+
+    def done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def wait(self):
+        """Waits for submitted calls to be done"""
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+
+    def pending_sources(self):
+        with self.lock:
+            return set(self.in_flight)
+
+    def close(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
@@ -1,23 +1,43 @@
+import dataclasses
+import functools
 import gzip
 import json
 import logging
-from dataclasses import dataclass
-from os import listdir
-from os.path import isfile, join
-from typing import List
+import logging.config
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from collections import deque
+from typing import Callable, Dict, Iterable, List
 
 import humps
 import numpy as np
 import pandas as pd
+from tabulate import tabulate
 
 from ..config import default_table_structure
 from ..config import event_fields
 from ..config.configuration import AppConf
-from ..util import json_util, dataframe_util
-from ..warehouse import factory as whf, warehouse as wh
+from ..config.data_type import DataType
+from ..util import json_util, dataframe_util, event_util, metrics
+from ..util.file_source import FileSource, Prefetcher, SourceFile
+from ..util.manifest import IngestManifest, file_checksum
+from ..util.dataframe_util import TypedFrame
+from ..util.memory_util import MB, MemoryTracker
+from ..util.profiler import FileProfiler
+from ..warehouse import factory as whf, schema_diff, warehouse as wh
+from . import pipeline
+from .write_buffer import WriteBuffer
 
 logger = logging.getLogger(__name__)
 
+DDL_LOCK_STRIPES = 64
+DECODE_BUFFER_SIZE = 1024 * 1024
+
 
 @dataclass()
 class EventDataFrames:
@@ -47,9 +67,23 @@ class EventDataFrames:
 
         if not dataframe_util.empty(self.tracks):
             self.tracks["original_event"] = self.tracks["event"]
-            self.tracks["event"] = self.tracks["event"].apply(
-                lambda x: humps.decamelize(x.replace(" ", "").replace("&", "and")).lower()
-            )
+            self.tracks["event"] = event_util.normalize_event_names(self.tracks["event"])
+
+    def row_counts(self):
+        return {
+            default_table_structure.TRACKS_TABLE: dataframe_util.row_count(self.tracks),
+            default_table_structure.IDENTITIES_TABLE: dataframe_util.row_count(self.identities),
+            default_table_structure.PAGES_TABLE: dataframe_util.row_count(self.pages),
+            default_table_structure.SCREENS_TABLE: dataframe_util.row_count(self.screens),
+            default_table_structure.GROUPS_TABLE: dataframe_util.row_count(self.groups),
+            default_table_structure.ALIASES_TABLE: dataframe_util.row_count(self.aliases),
+        }
+
+    def estimate_memory(self):
+        return sum(
+            dataframe_util.estimate_memory(df)
+            for df in [self.tracks, self.identities, self.pages, self.screens, self.groups, self.aliases]
+        )
 
     def summary(self):
         return f"""
@@ -80,55 +114,438 @@ class EventDataFrames:
                 df[event_fields.UNIX_TIMESTAMP_IN_MILLIS] = df[event_fields.TIMESTAMP].astype(np.int64) / int(1e6)
 
 
+@dataclass()
+class JobSummary:
+    """Class for collecting results of processed files."""
+
+    files: int = 0
+    empty_files: int = 0
+    skipped_files: int = 0
+    rows: Dict[str, int] = field(default_factory=dict)
+    peak_memory: Dict[str, int] = field(default_factory=dict)
+
+    def add_file(self, rows: Dict[str, int]):
+        self.files += 1
+        if not rows:
+            self.empty_files += 1
+        for table, count in rows.items():
+            self.rows[table] = self.rows.get(table, 0) + count
+
+    def add_peak_memory(self, peaks: Dict[str, int]):
+        for stage, nbytes in peaks.items():
+            self.peak_memory[stage] = max(self.peak_memory.get(stage, 0), nbytes)
+
+    def summary(self):
+        table = tabulate(sorted(self.rows.items()), headers=["table", "rows"])
+        memory = tabulate(
+            [(stage, round(nbytes / MB, 1)) for stage, nbytes in self.peak_memory.items()],
+            headers=["stage", "peak MB"],
+        )
+        return f"files = {self.files}, empty files = {self.empty_files}, " \
+               f"skipped files = {self.skipped_files}\n{table}\n{memory}"
+
+
 class SendToWarehouseJob:
     """ Handles whole process to send files to warehouse """
 
     app_conf: AppConf
-    source_dir: str
+    file_source: FileSource
     warehouse_namespace: str
     warehouse_schema: str
     warehouses: List[wh.Warehouse]
+    warehouse_names: List[str]
+    fan_out: pipeline.FanOut
     non_null_columns: List[str]
-
-    def __init__(self, app_conf: AppConf, source_dir: str, warehouse_namespace: str):
+    workers: int
+    prefetch: int
+    logging_config: str
+    ddl_locks: list
+    table_checks: Dict[str, Callable]
+    manifest: IngestManifest
+    write_buffer: WriteBuffer
+    memory: MemoryTracker
+    profiler: FileProfiler
+    writer: pipeline.Stage
+    current_file: str
+    failed_file: str
+    processed_files: List[str]
+    sent: deque
+    unsent_files: dict
+
+    def __init__(self, app_conf: AppConf, file_source: FileSource, warehouse_namespace: str, workers: int = 1,
+                 prefetch: int = 2, logging_config: str = None):
         self.app_conf = app_conf
-        self.source_dir = source_dir
+        self.file_source = file_source
         self.warehouse_namespace = warehouse_namespace
+        self.workers = workers
+        self.prefetch = prefetch
+        # Logging config file applied by worker processes, which are spawned without logging of this process
+        self.logging_config = logging_config
+        # Fails before connecting to warehouses when configured JSON backend is not installed
+        json_util.get_loads(app_conf.json_backend)
+        # Only one insert thread runs DDL for a table of a warehouse at a time. Worker processes share theirs.
+        self.ddl_locks = [threading.Lock() for _ in range(DDL_LOCK_STRIPES)]
+        self.table_checks = {}
+        self.manifest = None
+        self.write_buffer = WriteBuffer(
+            self.insert, app_conf.flush_rows, app_conf.flush_bytes, app_conf.flush_seconds
+        )
+        # Batches wait in reader and writer queues besides the ones being transformed and written
+        self.memory = MemoryTracker(
+            app_conf.max_memory_mb, 2 * app_conf.pipeline_queue_size + 2, self.write_buffer.enabled()
+        )
+        self.write_buffer.flush_bytes = self.memory.buffer_bytes(app_conf.flush_bytes)
+        self.write_buffer.max_bytes = self.memory.buffer_budget
+        if self.memory.budget:
+            logger.info(f"Memory budget = {app_conf.max_memory_mb} MB, batches of at most "
+                        f"{self.memory.batch_bytes(app_conf.batch_bytes)} raw bytes, "
+                        f"write buffer of at most {self.write_buffer.max_bytes} bytes")
+        self.profiler = FileProfiler(app_conf.profile_dir, app_conf.profile_rate, app_conf.profile_memory)
+        # Runs everything touching warehouses. Runs in calling thread until process_files starts a pipeline.
+        self.writer = pipeline.Stage("seghouse-writer", 0, after=self.collect_sent_files)
+        # File being transformed, reader is ahead of it
+        self.current_file = None
+        # File which could not be read
+        self.failed_file = None
+        # Files processed by this process whose rows may still be in write buffer, only used by writer
+        self.processed_files = []
+        # Files whose rows are all inserted, filled by writer
+        self.sent = deque()
+        # Files processed by any process, waiting for their rows to be sent before recording them in manifest
+        self.unsent_files = {}
         self.warehouse_schema = humps.decamelize(self.warehouse_namespace)
         self.warehouses = []
-        for warehouse_conf in app_conf.warehouses:
-            self.warehouses.append(whf.get_warehouse(warehouse_conf))
+        self.warehouse_names = []
+        limits = {}
+        for i, warehouse_conf in enumerate(app_conf.warehouses):
+            name = warehouse_conf.get("name", f"{warehouse_conf['type']}-{i}")
+            self.warehouses.append(whf.get_warehouse(warehouse_conf, name))
+            self.warehouse_names.append(name)
+            limits[name] = warehouse_conf.get("max_concurrent_inserts", 1)
+        # Inserts of every warehouse run on their own threads, so a slow or failing warehouse does not hold back others
+        self.fan_out = pipeline.FanOut(limits)
         self.non_null_columns = [event_fields.RECEIVED_AT, event_fields.TIMESTAMP, event_fields.MESSAGE_ID] + list(
             self.app_conf.extra_timestamps.keys())
 
     def execute(self):
-        file_names = [
-            f for f in listdir(self.source_dir) if isfile(join(self.source_dir, f))
-        ]
-        file_paths = [self.source_dir + "/" + x for x in file_names]
-
-        logger.info(f"Files to be sent to warehouses are : {file_paths}")
-
-        self.process(file_paths)
-
-    def process(self, file_paths):
+        metrics.registry.reset()
+        if self.profiler.enabled():
+            # Profiles of every run, also of its workers, go to a directory of their own
+            self.profiler.directory = os.path.join(self.app_conf.profile_dir, time.strftime("%Y%m%d-%H%M%S"))
+            logger.info(f"Profiling {self.app_conf.profile_rate:.0%} of files to {self.profiler.directory}")
+        source_files = self.file_source.list_files()
+        skipped_files = 0
+        if self.app_conf.manifest_file:
+            self.manifest = IngestManifest(self.app_conf.manifest_file)
+            location = self.file_source.location()
+            new_files = [f for f in source_files if not self.manifest.contains(self.warehouse_namespace, location, f)]
+            skipped_files = len(source_files) - len(new_files)
+            logger.info(f"Skipping {skipped_files} files which are already sent as per manifest")
+            source_files = new_files
+        metrics.inc("skipped_files", skipped_files)
+        logger.info(f"Files to be sent to warehouses are : {[f.name for f in source_files]}")
+
+        # Every worker holds one file while next files are fetched
+        prefetcher = Prefetcher(self.file_source, source_files, self.workers + self.prefetch)
+        started = time.time()
+        succeeded = False
+        try:
+            summary = self.process(prefetcher)
+            summary.skipped_files = skipped_files
+            self.log_summary(summary)
+            succeeded = True
+            return summary
+        finally:
+            prefetcher.close()
+            if self.manifest:
+                self.manifest.close()
+            if self.app_conf.metrics_file:
+                self.write_metrics(started, succeeded)
+
+    def log_summary(self, summary: JobSummary):
+        logger.info(f"Job Summary = {summary.summary()}")
+        logger.info(f"Metrics =\n{metrics.registry.summary()}")
+        profile_summary = self.profiler.summary()
+        if profile_summary:
+            logger.info(f"Profile = {profile_summary}")
+
+    def write_metrics(self, started: float, succeeded: bool):
+        """Exports metrics of job, also of a failed one, so that failures can be alerted on"""
+        metrics.registry.set("last_run_success", int(succeeded), namespace=self.warehouse_namespace)
+        metrics.registry.set("last_run_timestamp_seconds", round(started), namespace=self.warehouse_namespace)
+        metrics.registry.set("last_run_duration_seconds", time.time() - started, namespace=self.warehouse_namespace)
+        try:
+            metrics.registry.write(self.app_conf.metrics_file)
+        except Exception:
+            logger.exception(f"Unable to write metrics to {self.app_conf.metrics_file}")
+
+    def process(self, files: Prefetcher):
+        if self.workers > 1:
+            summary = self.process_in_workers(files)
+        else:
+            summary = JobSummary()
+            source_files = {}
+
+            def file_paths():
+                for source_file, file_path in files:
+                    source_files[file_path] = source_file
+                    yield file_path
+
+            def on_processed(file_path, rows):
+                self.complete_file(files, source_files.pop(file_path), file_path, rows, summary)
+                self.record_sent_files(self.sent_files())
+
+            try:
+                self.process_files(file_paths(), on_processed)
+                self.clean_up()
+            finally:
+                # Files sent before a failure are recorded, so that rerun skips them
+                self.record_sent_files(self.sent_files())
+        summary.add_peak_memory(self.peak_memory())
+        return summary
+
+    def complete_file(self, files: Prefetcher, source_file: SourceFile, file_path: str, rows: Dict[str, int],
+                      summary: JobSummary):
+        """Releases local copy of processed file. It is recorded in manifest once its rows are sent."""
+        summary.add_file(rows)
+        if self.manifest:
+            self.unsent_files[file_path] = (source_file, file_checksum(file_path), rows)
+        files.release(source_file, file_path)
+
+    def peak_memory(self):
+        """Peak bytes held by each stage of this process"""
+        self.memory.observe("write buffer", self.write_buffer.peak_bytes)
+        return self.memory.stage_peaks()
+
+    def mark_processed(self, file_path):
+        self.processed_files.append(file_path)
+
+    def mark_written(self, dropped_calls):
+        """
+        Marks processed the files whose mark got dropped by aborted writer although all their rows were written.
+        Calls run in order, so those are files none of whose rows are among dropped calls.
+        """
+        unwritten = {args[2] for fn, args in dropped_calls if fn == self.write_buffer.add}
+        for fn, args in dropped_calls:
+            if fn == self.mark_processed and args[0] not in unwritten:
+                self.mark_processed(args[0])
+
+    def collect_sent_files(self):
+        """
+        Moves processed files whose rows are no longer waiting in write buffer or being inserted to sent files.
+        Files with a failed insert are dropped, they are never sent.
+        """
+        pending = self.write_buffer.pending_sources() | self.fan_out.pending_sources()
+        failed = self.fan_out.failed_sources
+        self.sent.extend(f for f in self.processed_files if f not in pending and f not in failed)
+        self.processed_files = [f for f in self.processed_files if f in pending]
+
+    def sent_files(self):
+        """Returns files processed by this process whose rows got inserted since last call"""
+        return [self.sent.popleft() for _ in range(len(self.sent))]
+
+    def record_sent_files(self, file_paths: List[str]):
         for file_path in file_paths:
-            logger.info(f"Started processing {file_path}")
-            file_df = self.get_file_df(file_path)
+            if file_path in self.unsent_files:
+                source_file, checksum, rows = self.unsent_files.pop(file_path)
+                self.manifest.record(
+                    self.warehouse_namespace, self.file_source.location(), source_file, checksum, rows
+                )
+
+    def process_files(self, file_paths: Iterable[str], on_processed: Callable[[str, Dict[str, int]], None]):
+        """
+        Sends files to warehouses through reader -> transformer -> writer stages joined by bounded queues,
+        so that next batches are read and transformed while earlier ones are written.
+        Transformer runs in calling thread and calls on_processed(file_path, rows per event type) once file is done.
+        """
+        queue_size = self.app_conf.pipeline_queue_size
+        reader = pipeline.ReadAhead(self.read_files(file_paths), queue_size, "seghouse-reader")
+        self.writer = pipeline.Stage("seghouse-writer", queue_size, after=self.collect_sent_files)
+        try:
+            rows = {}
+            for file_path, file_df in reader:
+                if file_df is None:
+                    self.writer.submit(self.mark_processed, file_path)
+                    self.profiler.finish(file_path)
+                    on_processed(file_path, rows)
+                    rows = {}
+                    continue
+
+                self.current_file = file_path
+                with self.profiler.profile(file_path):
+                    file_rows = self.process_df(file_df)
+                for table, count in file_rows.items():
+                    rows[table] = rows.get(table, 0) + count
+            self.writer.submit(self.flush)
+            self.writer.close()
+        except BaseException:
+            dropped = self.writer.abort()
+            self.fan_out.wait()
+            if self.writer.error is None:
+                self.mark_written(dropped)
+            # Files sent before failure are handed over to be recorded in manifest, so that rerun skips them
+            self.collect_sent_files()
+            raise
+        finally:
+            reader.close()
+            self.writer = pipeline.Stage("seghouse-writer", 0, after=self.collect_sent_files)
+        self.raise_failures()
+
+    def raise_failures(self):
+        """Reports inserts which failed for some warehouse, after inserts to other warehouses are done"""
+        failures = self.fan_out.failures
+        if not failures:
+            return
+        # One row per warehouse and table with count of failed inserts and first error
+        targets = {}
+        for f in failures:
+            count, error = targets.get((f.target, f.name), (0, f.error))
+            targets[(f.target, f.name)] = (count + 1, error)
+        table = tabulate(
+            [(target, name, count, error) for (target, name), (count, error) in targets.items()],
+            headers=["warehouse", "table", "failed inserts", "first error"],
+        )
+        logger.error(f"Failed inserts =\n{table}")
+        raise Exception(f"{len(failures)} inserts failed, see failed inserts above. "
+                        f"Files with failed inserts are not recorded in manifest.")
 
-            if dataframe_util.empty(file_df):
+    def read_files(self, file_paths: Iterable[str]):
+        """Yields (file_path, dataframe) for every batch of every file and (file_path, None) once file is read"""
+        for file_path in file_paths:
+            logger.info(f"Started reading {file_path}")
+            self.profiler.start(file_path)
+            batch_count = 0
+            # Time spent decoding file, without time the consumer spends on its batches
+            read_seconds = 0.0
+            try:
+                file_dfs = self.get_file_dfs(
+                    file_path, self.app_conf.batch_rows, self.app_conf.batch_bytes, self.app_conf.json_backend,
+                    self.memory, self.app_conf.array_columns,
+                )
+                while True:
+                    started = time.perf_counter()
+                    with self.profiler.profile(file_path):
+                        file_df = next(file_dfs, None)
+                    read_seconds += time.perf_counter() - started
+                    if file_df is None:
+                        break
+                    batch_count += 1
+                    rows = dataframe_util.row_count(file_df)
+                    metrics.inc("read_rows", rows)
+                    logger.info(f"Read batch {batch_count} of {file_path}, rows = {rows}")
+                    yield file_path, file_df
+            except Exception as e:
+                metrics.inc("failed_files")
+                self.failed_file = file_path
+                raise Exception(f"Unable to read {file_path}: {e!r}") from e
+
+            metrics.observe("read_file_seconds", read_seconds)
+            metrics.inc("files")
+            metrics.inc("read_batches", batch_count)
+            metrics.inc("read_bytes", os.path.getsize(file_path))
+            if batch_count == 0:
                 logger.info(f"File {file_path} is empty")
-                continue
-
-            logger.info(f"Removing columns = {self.app_conf.skip_fields}")
-            file_df = file_df.drop(columns=self.app_conf.skip_fields, errors='ignore')
-
-            event_data_frames = self.break_down_by_type(file_df)
+            else:
+                logger.info(f"Completed reading {file_path}")
+            yield file_path, None
+
+    def process_in_workers(self, files: Prefetcher):
+        """Spreads files over worker processes. Each worker has its own warehouse connections."""
+        context = multiprocessing.get_context("spawn")
+        ddl_locks = [context.Lock() for _ in range(DDL_LOCK_STRIPES)]
+        tasks = context.Queue()
+        results = context.Queue()
+        # Every worker gets an equal share of memory budget and writes profiles next to the ones of other workers
+        worker_conf = dataclasses.replace(
+            self.app_conf,
+            max_memory_mb=max(self.app_conf.max_memory_mb // self.workers, 1) if self.app_conf.max_memory_mb else 0,
+            profile_dir=self.profiler.directory,
+        )
+        in_progress = {}
+        feed_errors = []
+
+        def feed():
+            try:
+                for source_file, file_path in files:
+                    in_progress[file_path] = source_file
+                    tasks.put(file_path)
+            except BaseException as e:
+                feed_errors.append(e)
+            finally:
+                for _ in range(self.workers):
+                    tasks.put(None)
+
+        processes = [
+            context.Process(
+                target=run_worker,
+                args=(worker_conf, self.warehouse_namespace, self.logging_config, ddl_locks, tasks, results),
+                name=f"seghouse-worker-{i}",
+            )
+            for i in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        logger.info(f"Started {self.workers} workers")
+        feeder = threading.Thread(target=feed, name="seghouse-feeder", daemon=True)
+        feeder.start()
+
+        summary = JobSummary()
+        finished_workers = 0
+        try:
+            while finished_workers < self.workers:
+                if feed_errors:
+                    raise Exception(f"Unable to fetch files: {feed_errors[0]!r}")
+                try:
+                    kind, file_path, result = results.get(timeout=1)
+                except queue.Empty:
+                    crashed = [p.name for p in processes if p.exitcode not in (None, 0)]
+                    if crashed:
+                        raise Exception(f"Workers {crashed} exited without reporting results")
+                    continue
+
+                if kind == "error":
+                    if file_path is None:
+                        raise Exception(f"Worker failed: {result}")
+                    raise Exception(f"Worker failed to process {file_path}: {result}")
+                elif kind == "processed":
+                    self.complete_file(files, in_progress.pop(file_path), file_path, result, summary)
+                elif kind == "sent":
+                    self.record_sent_files([file_path])
+                else:
+                    peaks, worker_metrics = result
+                    summary.add_peak_memory(peaks)
+                    metrics.registry.merge(worker_metrics)
+                    finished_workers += 1
+        except BaseException:
+            for process in processes:
+                process.terminate()
+            raise
+        finally:
+            for process in processes:
+                process.join()
+            self.clean_up()
+        return summary
+
+    def process_df(self, file_df):
+        with metrics.timer("transform_seconds"):
+            return self.transform(file_df)
+
+    def transform(self, file_df):
+        logger.info(f"Removing columns = {self.app_conf.skip_fields}")
+        # Unlike DataFrame.drop, deleting columns of a shallow copy does not copy remaining columns
+        file_df = file_df.copy(deep=False)
+        for column in self.app_conf.skip_fields:
+            if column in file_df.columns:
+                del file_df[column]
+
+        event_data_frames = self.break_down_by_type(file_df)
+        self.memory.observe(
+            "transform", dataframe_util.estimate_memory(file_df) + event_data_frames.estimate_memory()
+        )
 
-            event_data_frames.set_extra_timestamps(self.app_conf.extra_timestamps)
-            self.store(event_data_frames)
-            logger.info(f"Completed processing {file_path}")
-        self.clean_up()
+        event_data_frames.set_extra_timestamps(self.app_conf.extra_timestamps)
+        self.store(event_data_frames)
+        return event_data_frames.row_counts()
 
     def store(self, event_data_frames: EventDataFrames):
         self.store_identities(event_data_frames.identities)
@@ -138,55 +555,85 @@ class SendToWarehouseJob:
         self.store_groups(event_data_frames.groups)
         self.store_aliases(event_data_frames.aliases)
 
+    def submit_insert(self, table, frame: TypedFrame, table_check: Callable):
+        """Hands frame over to writer, which buffers it for table. table_check makes sure a table fits frame."""
+        metrics.inc("rows", dataframe_util.row_count(frame.df), table=table)
+        self.writer.submit(self.write_buffer.add, table, frame, self.current_file, table_check)
+
+    def insert(self, table, frame: TypedFrame, sources, table_checks: Dict[Callable, Dict[str, DataType]]):
+        for name, warehouse in zip(self.warehouse_names, self.warehouses):
+            # Every warehouse casts its own shallow copy, so insert threads never share a data frame
+            warehouse_frame = TypedFrame(frame.df.copy(deep=False), frame.col_types)
+            self.fan_out.submit(
+                name, table, sources, self.insert_into, name, warehouse, table, warehouse_frame, table_checks
+            )
+
+    def insert_into(self, name, warehouse, table, frame: TypedFrame,
+                    table_checks: Dict[Callable, Dict[str, DataType]] = None):
+        """
+        Runs table checks with their column types and inserts frame into table of a warehouse.
+        Runs on insert threads of warehouse, so a failing warehouse only fails its own inserts.
+        """
+        for table_check, col_types in (table_checks or {}).items():
+            table_check(name, warehouse, TypedFrame(frame.df, col_types))
+        try:
+            with metrics.timer("insert_seconds", warehouse=name, table=table):
+                warehouse.insert_df(self.warehouse_schema, table, frame.df, frame.col_types)
+        except Exception:
+            metrics.inc("failed_inserts", warehouse=name, table=table)
+            raise
+        metrics.inc("inserted_rows", dataframe_util.row_count(frame.df), warehouse=name, table=table)
+
+    def flush(self):
+        """Inserts buffered rows and waits for all inserts to be done"""
+        self.write_buffer.flush_all()
+        self.fan_out.wait()
+
     def clean_up(self):
+        self.flush()
+        self.raise_failures()
+        self.fan_out.close()
         for warehouse in self.warehouses:
             warehouse.close()
 
     def store_identities(self, identities_df):
         if not dataframe_util.empty(identities_df):
-            col_types = dataframe_util.get_datatypes(identities_df)
-            logger.debug(f"Col, Types = {col_types}")
+            identities = self.typed_frame(default_table_structure.IDENTITIES_TABLE, identities_df)
+            logger.debug(f"Col, Types = {identities.col_types}")
 
-            identities_df = dataframe_util.mark_nan_to_none(identities_df)
+            dataframe_util.mark_nan_to_none(identities.df)
 
-            self.ensure_table_structure(
-                self.warehouse_schema,
-                default_table_structure.IDENTITIES_TABLE,
-                default_table_structure.IDENTITIES,
-                col_types,
-            )
-            for warehouse in self.warehouses:
-                warehouse.insert_df(self.warehouse_schema, default_table_structure.IDENTITIES_TABLE, identities_df)
+            table_check = self.table_check(default_table_structure.IDENTITIES_TABLE, default_table_structure.IDENTITIES)
+            self.submit_insert(default_table_structure.IDENTITIES_TABLE, identities, table_check)
 
-            self.store_users(identities_df)
+            self.store_users(identities)
 
-    def store_users(self, identities_df):
-        users_df = identities_df.copy()
+    def store_users(self, identities: TypedFrame):
+        # Shallow copy, columns of identities are shared and only ver is added
+        users_df = identities.df.copy(deep=False)
         users_df['ver'] = users_df['timestamp'].astype(int)
 
-        col_types = dataframe_util.get_datatypes(users_df)
+        col_types = dict(identities.col_types)
+        col_types['ver'] = DataType.INT64
         logger.debug(f"Col, Types = {col_types}")
+        users = TypedFrame(users_df, col_types)
 
-        self.ensure_users_table_structure(
-            self.warehouse_schema,
-            default_table_structure.USERS,
-            col_types,
+        table_check = self.table_check(
+            default_table_structure.USERS_TABLE, default_table_structure.USERS, self.ensure_users_table_structure
         )
-        for warehouse in self.warehouses:
-            warehouse.insert_df(self.warehouse_schema, default_table_structure.USERS_TABLE, users_df)
+        self.submit_insert(default_table_structure.USERS_TABLE, users, table_check)
 
-    def ensure_users_table_structure(self, schema, default_structure, col_types):
-        table = default_table_structure.USERS_TABLE
+    def ensure_users_table_structure(self, schema, table, default_structure, name, warehouse, frame: TypedFrame):
         users_non_null_columns = self.non_null_columns + ['ver', 'user_id']
+        low_cardinality_columns = schema_diff.LowCardinalityColumns(self.app_conf.low_cardinality, frame.df)
         logger.debug(f"default_structure = {default_structure}")
-        for warehouse in self.warehouses:
+        with self.ddl_lock(name, table), metrics.timer("schema_seconds", warehouse=name, table=table):
             warehouse.create_schema(schema)
-            warehouse.create_users_table(schema, default_structure, users_non_null_columns)
+            warehouse.create_users_table(schema, default_structure, users_non_null_columns, low_cardinality_columns)
 
-            table_col_types = warehouse.describe_table(schema, table)
-            for col_name, col_type in col_types.items():
-                if col_name not in table_col_types:
-                    warehouse.add_column(schema, table, col_name, col_type, users_non_null_columns)
+            self.apply_schema_diff(
+                warehouse, schema, table, frame.col_types, users_non_null_columns, low_cardinality_columns
+            )
 
     def store_tracks(self, tracks_df):
         if not dataframe_util.empty(tracks_df):
@@ -195,174 +642,247 @@ class SendToWarehouseJob:
                 list(default_table_structure.TRACKS.keys()) + list(self.app_conf.extra_timestamps.keys()),
                 default_table_structure.TRACKS_ALLOWED_FIELD_PREFIXES,
             )
-            col_types = dataframe_util.get_datatypes(selected_col_df)
-            logger.debug(f"Col, Types = {col_types}")
+            selected = self.typed_frame(default_table_structure.TRACKS_TABLE, selected_col_df)
+            logger.debug(f"Col, Types = {selected.col_types}")
 
-            selected_col_df = dataframe_util.mark_nan_to_none(selected_col_df)
+            dataframe_util.mark_nan_to_none(selected.df)
 
-            self.ensure_table_structure(
-                self.warehouse_schema,
-                default_table_structure.TRACKS_TABLE,
-                default_table_structure.TRACKS,
-                col_types,
-            )
-            for warehouse in self.warehouses:
-                warehouse.insert_df(self.warehouse_schema, default_table_structure.TRACKS_TABLE, selected_col_df)
+            table_check = self.table_check(default_table_structure.TRACKS_TABLE, default_table_structure.TRACKS)
+            self.submit_insert(default_table_structure.TRACKS_TABLE, selected, table_check)
 
             self.store_individual_events(tracks_df)
 
     def store_individual_events(self, tracks_df):
-        all_events = sorted(tracks_df["event"].unique())
-        for event in all_events:
-            event_df = tracks_df[tracks_df["event"] == event].copy()
-            event_col_types = dataframe_util.get_datatypes(event_df)
-            logger.debug(f"Event = {event}, Col, Types = {event_col_types}")
-            table = event
-            if table in default_table_structure.DEFAULT_TABLES:
-                table = f"esc_{table}"
-
-            event_df = dataframe_util.mark_nan_to_none(event_df)
-            self.ensure_table_structure(
-                self.warehouse_schema,
-                table,
-                default_table_structure.TRACKS,
-                event_col_types,
-            )
-            for warehouse in self.warehouses:
-                warehouse.insert_df(self.warehouse_schema, table, event_df)
+        for event, event_df in dataframe_util.partition_by(tracks_df, "event", sort=True).items():
+            table = event_util.event_table_name(event)
+            event_frame = self.typed_frame(table, event_df)
+            logger.debug(f"Event = {event}, Col, Types = {event_frame.col_types}")
+
+            dataframe_util.mark_nan_to_none(event_frame.df)
+            self.submit_insert(table, event_frame, self.table_check(table, default_table_structure.TRACKS))
 
     def store_screens(self, screens_df):
         if not dataframe_util.empty(screens_df):
-            col_types = dataframe_util.get_datatypes(screens_df)
-            logger.info(f"Col, Types = {col_types}")
+            screens = self.typed_frame(default_table_structure.SCREENS_TABLE, screens_df)
+            logger.info(f"Col, Types = {screens.col_types}")
 
-            screens_df = dataframe_util.mark_nan_to_none(screens_df)
+            dataframe_util.mark_nan_to_none(screens.df)
 
-            self.ensure_table_structure(
-                self.warehouse_schema,
-                default_table_structure.SCREENS_TABLE,
-                default_table_structure.SCREENS,
-                col_types,
-            )
-            for warehouse in self.warehouses:
-                warehouse.insert_df(self.warehouse_schema, default_table_structure.SCREENS_TABLE, screens_df)
+            table_check = self.table_check(default_table_structure.SCREENS_TABLE, default_table_structure.SCREENS)
+            self.submit_insert(default_table_structure.SCREENS_TABLE, screens, table_check)
 
     def store_pages(self, pages_df):
         if not dataframe_util.empty(pages_df):
-            col_types = dataframe_util.get_datatypes(pages_df)
-            logger.info(f"Col, Types = {col_types}")
+            pages = self.typed_frame(default_table_structure.PAGES_TABLE, pages_df)
+            logger.info(f"Col, Types = {pages.col_types}")
 
-            pages_df = dataframe_util.mark_nan_to_none(pages_df)
+            dataframe_util.mark_nan_to_none(pages.df)
 
-            self.ensure_table_structure(
-                self.warehouse_schema,
-                default_table_structure.PAGES_TABLE,
-                default_table_structure.PAGES,
-                col_types,
-            )
-            for warehouse in self.warehouses:
-                warehouse.insert_df(self.warehouse_schema, default_table_structure.PAGES_TABLE, pages_df)
+            table_check = self.table_check(default_table_structure.PAGES_TABLE, default_table_structure.PAGES)
+            self.submit_insert(default_table_structure.PAGES_TABLE, pages, table_check)
 
     def store_groups(self, groups_df):
         if not dataframe_util.empty(groups_df):
-            col_types = dataframe_util.get_datatypes(groups_df)
-            logger.debug(f"Col, Types = {col_types}")
+            # Rows of groups are inserted into identities
+            groups = self.typed_frame(default_table_structure.IDENTITIES_TABLE, groups_df)
+            logger.debug(f"Col, Types = {groups.col_types}")
 
-            groups_df = dataframe_util.mark_nan_to_none(groups_df)
+            dataframe_util.mark_nan_to_none(groups.df)
 
-            self.ensure_table_structure(
-                self.warehouse_schema,
-                default_table_structure.GROUPS_TABLE,
-                default_table_structure.GROUPS,
-                col_types,
-            )
-            for warehouse in self.warehouses:
-                warehouse.insert_df(self.warehouse_schema, "identities", groups_df)
+            table_check = self.table_check(default_table_structure.GROUPS_TABLE, default_table_structure.GROUPS)
+            self.submit_insert("identities", groups, table_check)
 
     def store_aliases(self, aliases_df):
         if not dataframe_util.empty(aliases_df):
-            col_types = dataframe_util.get_datatypes(aliases_df)
-            logger.debug(f"Col, Types = {col_types}")
+            # Rows of aliases are inserted into identities
+            aliases = self.typed_frame(default_table_structure.IDENTITIES_TABLE, aliases_df)
+            logger.debug(f"Col, Types = {aliases.col_types}")
 
-            aliases_df = dataframe_util.mark_nan_to_none(aliases_df)
+            dataframe_util.mark_nan_to_none(aliases.df)
 
-            self.ensure_table_structure(
-                self.warehouse_schema,
-                default_table_structure.ALIASES_TABLE,
-                default_table_structure.ALIASES,
-                col_types,
-            )
-            for warehouse in self.warehouses:
-                warehouse.insert_df(self.warehouse_schema, "identities", aliases_df)
+            table_check = self.table_check(default_table_structure.ALIASES_TABLE, default_table_structure.ALIASES)
+            self.submit_insert("identities", aliases, table_check)
+
+    def typed_frame(self, table, df):
+        """Infers column types of rows of table, once columns configured for it are packed into map columns"""
+        map_columns = self.app_conf.map_columns.get(table)
+        if map_columns is not None:
+            df = dataframe_util.pack_map_columns(df, map_columns)
+        return TypedFrame.infer(df)
 
-    def ensure_table_structure(self, schema, table, default_structure, col_types):
+    def ensure_table_structure(self, schema, table, default_structure, name, warehouse, frame: TypedFrame):
+        """Creates table in warehouse and adds columns of frame missing in it. Columns are typed by rows of frame."""
         logger.debug(f"default_structure = {default_structure}")
-        for warehouse in self.warehouses:
+        low_cardinality_columns = schema_diff.LowCardinalityColumns(self.app_conf.low_cardinality, frame.df)
+        with self.ddl_lock(name, table), metrics.timer("schema_seconds", warehouse=name, table=table):
             warehouse.create_schema(schema)
-            warehouse.create_table(schema, table, default_structure, self.non_null_columns)
+            warehouse.create_table(schema, table, default_structure, self.non_null_columns, low_cardinality_columns)
 
-            table_col_types = warehouse.describe_table(schema, table)
-            for col_name, col_type in col_types.items():
-                if col_name not in table_col_types:
-                    warehouse.add_column(schema, table, col_name, col_type, self.non_null_columns)
+            self.apply_schema_diff(
+                warehouse, schema, table, frame.col_types, self.non_null_columns, low_cardinality_columns
+            )
+
+    def table_check(self, table, default_structure, ensure: Callable = None):
+        """
+        Returns ensure_table_structure, or ensure, for table. Same call is returned for a table every time,
+        so that write buffer runs it once per flush.
+        """
+        check = self.table_checks.get(table)
+        if check is None:
+            check = functools.partial(
+                ensure or self.ensure_table_structure, self.warehouse_schema, table, default_structure
+            )
+            self.table_checks[table] = check
+        return check
+
+    def ddl_lock(self, name, table):
+        """Returns lock to be held while creating or altering table of warehouse"""
+        return self.ddl_locks[zlib.crc32(f"{name}.{table}".encode()) % len(self.ddl_locks)]
+
+    @staticmethod
+    def apply_schema_diff(warehouse, schema, table, col_types, non_null_columns, low_cardinality_columns=()):
+        """Adds all missing columns of batch to table in one schema change"""
+        diff = schema_diff.plan(schema, table, col_types, warehouse.describe_table(schema, table))
+        if diff.empty():
+            return
+        logger.info(f"Schema change plan = {diff.summary()}")
+        warehouse.add_columns(schema, table, diff.new_columns, non_null_columns, low_cardinality_columns)
 
     @staticmethod
     def select_columns(df, keep_columns, keep_columns_with_prefixes):
         col_names = df.columns.values
-        selected_col_names = set()
+        selected_col_names = []
         for col_name in col_names:
-            if col_name in keep_columns:
-                selected_col_names.add(col_name)
-
-            if col_name.startswith(keep_columns_with_prefixes):
-                selected_col_names.add(col_name)
+            if col_name in keep_columns or col_name.startswith(keep_columns_with_prefixes):
+                selected_col_names.append(col_name)
         logger.debug(f"selected_col_names = {selected_col_names}")
         return df[selected_col_names]
 
     @staticmethod
     def get_file_df(file_path):
-        data = []
+        """Reads whole file in a single dataframe"""
+        return next(SendToWarehouseJob.get_file_dfs(file_path), pd.DataFrame())
+
+    @staticmethod
+    def get_file_dfs(file_path, batch_rows=0, batch_bytes=0, json_backend="auto", memory: MemoryTracker = None,
+                     array_columns=False):
+        """
+        Yields dataframes of at most batch_rows rows or batch_bytes raw bytes.
+        0 means no limit, so whole file is yielded as one dataframe.
+        memory measures every dataframe and may lower the limits to keep batches in its budget.
+        With array_columns lists of JSON events are kept as lists, see json_util.flatten_list.
+        """
         if file_path.endswith(".parquet"):
             logger.info(f"Reading parquet file")
-            df = pd.read_parquet(path=file_path, engine="pyarrow")
-            return df
-        elif file_path.endswith(".gz"):
+            if memory:
+                batch_rows = memory.batch_rows(batch_rows)
+            if batch_rows:
+                import pyarrow.parquet as pq
+                dfs = (b.to_pandas() for b in pq.ParquetFile(file_path).iter_batches(batch_size=batch_rows))
+            else:
+                dfs = iter([pd.read_parquet(path=file_path, engine="pyarrow")])
+            for df in dfs:
+                if memory:
+                    memory.observe_batch(df)
+                yield df
+            return
+
+        max_bytes = memory.batch_bytes(batch_bytes) if memory else batch_bytes
+        batch = []
+        batch_size = 0
+        for line_size, flattened_event in SendToWarehouseJob.read_events(file_path, json_backend, array_columns):
+            batch.append(flattened_event)
+            batch_size += line_size
+            if (batch_rows and len(batch) >= batch_rows) or (max_bytes and batch_size >= max_bytes):
+                yield SendToWarehouseJob.to_batch_df(batch, batch_size, memory)
+                batch = []
+                batch_size = 0
+                # Size of dataframes per raw byte is known better after every batch
+                max_bytes = memory.batch_bytes(batch_bytes) if memory else batch_bytes
+
+        if batch:
+            yield SendToWarehouseJob.to_batch_df(batch, batch_size, memory)
+
+    @staticmethod
+    def to_batch_df(batch, batch_size, memory: MemoryTracker = None):
+        df = SendToWarehouseJob.to_df(batch)
+        # Events are dropped before dataframe is yielded, so both are not held while batch is processed
+        batch.clear()
+        if memory:
+            memory.observe_batch(df, batch_size)
+        return df
+
+    @staticmethod
+    def read_events(file_path, json_backend="auto", array_columns=False):
+        """Yields (line size, flattened event) for every event in json or json.gz file"""
+        if file_path.endswith(".gz"):
             logger.info(f"Reading gz file")
             opener = gzip.open
         else:
             opener = open
 
-        with opener(file_path, "r") as f:
-            for line in f:
-                event_json = json.loads(line)
-                snake_cased_event_json = humps.decamelize(event_json)
-                data.append(snake_cased_event_json)
-
-        logger.debug(
-            f"first 5 event json objects = {json.dumps(data[0:5], indent=4, default=str)}"
-        )
-
-        flattened_data = []
-        for d in data:
-            flattened_data.append(json_util.flatten_json(d))
+        loads = json_util.get_loads(json_backend)
+        with opener(file_path, "rb") as f:
+            # Decode lines of a whole buffer at once instead of one call per line
+            for lines in iter(lambda: f.readlines(DECODE_BUFFER_SIZE), []):
+                for line, event_json in zip(lines, json_util.loads_lines(lines, loads)):
+                    yield len(line), json_util.flatten_event(event_json, array_columns)
 
-        logger.debug(
-            f"first 5 flattened event json objects = {json.dumps(flattened_data[0:5], indent=4, default=str)}"
-        )
-
-        logger.info(f" gz file to dataframe complete")
+    @staticmethod
+    def to_df(flattened_data):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"first 5 flattened event json objects = {json.dumps(flattened_data[0:5], indent=4, default=str)}"
+            )
         df = pd.DataFrame(flattened_data)
+        logger.info(f"Events to dataframe complete, rows = {dataframe_util.row_count(df)}")
         return df
 
     @staticmethod
     def break_down_by_type(df):
+        frames = dataframe_util.partition_by(df, "type")
+
+        def frame(event_type):
+            return frames[event_type] if event_type in frames else df.iloc[:0].copy()
+
         event_data_frames = EventDataFrames(
-            tracks=df[df["type"] == "track"].copy(),
-            identities=df[df["type"] == "identify"].copy(),
-            pages=df[df["type"] == "page"].copy(),
-            screens=df[df["type"] == "screen"].copy(),
-            groups=df[df["type"] == "group"].copy(),
-            aliases=df[df["type"] == "alias"].copy(),
+            tracks=frame("track"),
+            identities=frame("identify"),
+            pages=frame("page"),
+            screens=frame("screen"),
+            groups=frame("group"),
+            aliases=frame("alias"),
         )
         logger.info(f"Event Data Frames Summary = {event_data_frames.summary()}")
         return event_data_frames
+
+
+def run_worker(app_conf, warehouse_namespace, logging_config, ddl_locks, tasks, results):
+    """
+    Runs in worker process. Configures logging with logging_config file, if given,
+    and processes files from tasks queue until None is received.
+    Puts ("processed", file_path, rows) once file is read, ("sent", file_path, None) once its rows are inserted,
+    ("error", file_path, error) on failure and ("done", None, (peak memory per stage, metrics)) once done.
+    """
+    if logging_config:
+        logging.config.fileConfig(logging_config)
+    job = SendToWarehouseJob(app_conf, None, warehouse_namespace)
+    job.ddl_locks = ddl_locks
+
+    def on_processed(file_path, rows):
+        results.put(("processed", file_path, rows))
+        for sent_file in job.sent_files():
+            results.put(("sent", sent_file, None))
+
+    try:
+        job.process_files(iter(tasks.get, None), on_processed)
+        job.clean_up()
+        for sent_file in job.sent_files():
+            results.put(("sent", sent_file, None))
+        results.put(("done", None, (job.peak_memory(), metrics.registry.snapshot())))
+    except Exception as e:
+        failed_file = job.failed_file or job.current_file
+        logger.exception(f"Worker failed to process {failed_file}")
+        for sent_file in job.sent_files():
+            results.put(("sent", sent_file, None))
+        results.put(("error", failed_file, repr(e)))
@@ -0,0 +1,108 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Set
+
+from ..config.data_type import DataType
+from ..util import dataframe_util, metrics
+from ..util.dataframe_util import TypedFrame
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass()
+class TableBuffer:
+    """Data frames waiting to be inserted into a table"""
+
+    frames: List[TypedFrame] = field(default_factory=list)
+    rows: int = 0
+    bytes: int = 0
+    created_at: float = 0.0
+    sources: Set[str] = field(default_factory=set)
+    # Column types of data frames per call making sure a table fits them, first type of a column wins
+    table_checks: Dict[Callable, Dict[str, DataType]] = field(default_factory=dict)
+
+
+class WriteBuffer:
+    """
+    Coalesces data frames of a table across batches and files, so that warehouses get fewer, larger inserts.
+    A table is flushed once its rows, bytes or age reach the thresholds. 0 disables a threshold.
+    Largest tables are flushed once all tables hold more than max_bytes.
+    With no thresholds at all every data frame is written right away.
+    write is called with table, data frame with its column types, sources of its rows and table checks.
+    """
+
+    def __init__(self, write: Callable[[str, TypedFrame, Set[str], Dict[Callable, Dict[str, DataType]]], None],
+                 flush_rows: int = 0, flush_bytes: int = 0, flush_seconds: float = 0, max_bytes: int = 0):
+        self.write = write
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.tables: Dict[str, TableBuffer] = {}
+        self.peak_bytes = 0
+
+    def enabled(self):
+        return bool(self.flush_rows or self.flush_bytes or self.flush_seconds)
+
+    def add(self, table: str, frame: TypedFrame, source: str = None, table_check: Callable = None):
+        if not self.enabled():
+            table_checks = {table_check: frame.col_types} if table_check else {}
+            self.write(table, frame, {source} if source else set(), table_checks)
+            return
+
+        buffer = self.tables.get(table)
+        if buffer is None:
+            buffer = self.tables[table] = TableBuffer(created_at=time.monotonic())
+        buffer.frames.append(frame)
+        buffer.rows += dataframe_util.row_count(frame.df)
+        buffer.bytes += dataframe_util.estimate_memory(frame.df)
+        if source:
+            buffer.sources.add(source)
+        if table_check:
+            col_types = buffer.table_checks.setdefault(table_check, {})
+            for column, column_type in frame.col_types.items():
+                col_types.setdefault(column, column_type)
+        self.peak_bytes = max(self.peak_bytes, self.buffered_bytes())
+
+        if (self.flush_rows and buffer.rows >= self.flush_rows) or \
+                (self.flush_bytes and buffer.bytes >= self.flush_bytes):
+            self.flush(table)
+        self.flush_expired()
+        self.flush_largest()
+
+    def flush_largest(self):
+        """Flushes largest tables until all tables fit in max_bytes"""
+        if not self.max_bytes:
+            return
+        while self.tables and self.buffered_bytes() > self.max_bytes:
+            self.flush(max(self.tables, key=lambda t: self.tables[t].bytes))
+
+    def flush_expired(self):
+        if not self.flush_seconds:
+            return
+        now = time.monotonic()
+        for table in [t for t, b in self.tables.items() if now - b.created_at >= self.flush_seconds]:
+            self.flush(table)
+
+    def flush(self, table: str):
+        buffer = self.tables.pop(table, None)
+        if buffer is None:
+            return
+        logger.info(f"Flushing {buffer.rows} rows of {len(buffer.frames)} data frames to {table}")
+        metrics.inc("buffer_flushes", table=table)
+        frame = TypedFrame.concat(buffer.frames)
+        # Buffered data frames are freed while their rows are inserted
+        buffer.frames.clear()
+        self.write(table, frame, buffer.sources, buffer.table_checks)
+
+    def flush_all(self):
+        for table in list(self.tables):
+            self.flush(table)
+
+    def buffered_bytes(self):
+        return sum(b.bytes for b in self.tables.values())
+
+    def pending_sources(self):
+        """Sources which still have rows waiting in buffer"""
+        return set().union(*(b.sources for b in self.tables.values()))
@@ -1,26 +1,33 @@
 import logging
 import subprocess
-import uuid
 
 logger = logging.getLogger(__name__)
 
 TMP_DIR_PREFIX = "seghouse"
 
 
-def s3_copy(s3_path, local_dir_path):
-    #command = ["aws", "s3", "cp", s3_path, local_dir_path, "--recursive", "--exclude", "*", "--include", "*.gz"]
-    command = ["aws", "s3", "cp", s3_path, local_dir_path, "--recursive"]
+def s3_list(s3_dir, endpoint_url=None):
+    """Returns (name, size) of files directly under s3_dir"""
+    command = ["aws", "s3", "ls", s3_dir.rstrip("/") + "/"] + endpoint_args(endpoint_url)
     logger.info(f"command = {command}")
-    process = subprocess.run(command)
+    process = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
     process.check_returncode()
 
+    files = []
+    for line in process.stdout.splitlines():
+        # Lines look like "2021-01-01 10:00:00      12345 file.json.gz", sub directories like "PRE dir/"
+        parts = line.split(maxsplit=3)
+        if len(parts) == 4 and parts[2].isdigit():
+            files.append((parts[3], int(parts[2])))
+    return files
+
 
-def download_gz_files(s3_dir):
-    local_dir_name = str(uuid.uuid4()).replace("-", "")
-    local_dir_path = f"/tmp/{TMP_DIR_PREFIX}-{local_dir_name}"
-    subprocess.run(["mkdir", "-p", local_dir_path])
+def s3_copy_file(s3_path, local_path, endpoint_url=None):
+    command = ["aws", "s3", "cp", s3_path, local_path, "--only-show-errors"] + endpoint_args(endpoint_url)
+    logger.info(f"command = {command}")
+    process = subprocess.run(command)
+    process.check_returncode()
 
-    logger.info(f"Copying files to {local_dir_path}")
-    s3_copy(s3_dir, local_dir_path)
 
-    return local_dir_path
+def endpoint_args(endpoint_url):
+    return ["--endpoint-url", endpoint_url] if endpoint_url else []
@@ -1,54 +1,214 @@
+import json
 import logging
+from collections import Counter
+from itertools import chain
+from dataclasses import dataclass
+from typing import Dict, List
 
 import numpy as np
 import pandas as pd
 
+from . import metrics
 from ..config import event_fields, data_type
 
 logger = logging.getLogger(__name__)
 
-
-def get_datatypes(df):
-    column_names = list(df.columns.values)
+PARSE_CHUNK_SIZE = 1024
+MEMORY_SAMPLE_ROWS = 1000
+INFERRED_PYTHON_TYPES = {"string": str, "integer": int, "floating": float, "boolean": bool}
+# Data types of object columns whose values pandas infers to be of a single kind
+INFERRED_DATATYPES = {
+    "string": data_type.DataType.STRING,
+    "integer": data_type.DataType.INT64,
+    "floating": data_type.DataType.FLOAT64,
+    "mixed-integer-float": data_type.DataType.FLOAT64,
+    "boolean": data_type.DataType.BOOLEAN,
+}
+# Array type of each type of elements, arrays of other elements hold strings
+ELEMENT_ARRAY_DATATYPES = {
+    data_type.DataType.INT64: data_type.DataType.ARRAY_INT64,
+    data_type.DataType.BOOLEAN: data_type.DataType.ARRAY_INT64,
+    data_type.DataType.FLOAT64: data_type.DataType.ARRAY_FLOAT64,
+}
+# Python type of elements of each array type
+ARRAY_ELEMENT_TYPES = {
+    data_type.DataType.ARRAY: str,
+    data_type.DataType.ARRAY_INT64: int,
+    data_type.DataType.ARRAY_FLOAT64: float,
+}
+
+
+@dataclass()
+class TypedFrame:
+    """Data frame with data types of its columns, inferred once and handed along instead of inferred again"""
+
+    df: pd.DataFrame
+    col_types: Dict[str, data_type.DataType]
+
+    @staticmethod
+    def infer(df):
+        return TypedFrame(df, get_datatypes(df))
+
+    @staticmethod
+    def concat(frames: List["TypedFrame"]):
+        """Concatenates frames, columns missing or typed differently in some frames are inferred again"""
+        if len(frames) == 1:
+            return frames[0]
+        # Columns missing in some data frames come out as NaN
+        df = pd.concat([f.df for f in frames], ignore_index=True, sort=False)
+        col_types = {}
+        stale = []
+        for column in df.columns:
+            types = {f.col_types.get(column) for f in frames}
+            if len(types) == 1 and None not in types:
+                col_types[column] = types.pop()
+            else:
+                stale.append(column)
+        inferred = get_datatypes(df, stale, keep_nulls=True)
+        mark_nan_to_none(df)
+        return TypedFrame(df, {c: col_types[c] if c in col_types else inferred[c]
+                               for c in df.columns if c in col_types or c in inferred})
+
+
+def get_datatypes(df, columns=None, keep_nulls=False):
+    """Returns data types of columns of df, all if columns is None. String columns are converted to str in place"""
+    if empty(df):
+        return {}
+    column_names = list(df.columns.values) if columns is None else list(columns)
+    dtypes = dict(zip(df.columns, df.dtypes))
     column_datatypes = {}
+    # Replaced at once, as replacing columns one by one copies rest of their block every time
+    to_str = []
 
     for c in column_names:
-        first_good_value = first_valid_value(df, c)
-        if first_good_value is None:
-            # skip this column
-            continue
-
-        if df[c].dtype == object and isinstance(first_good_value, str):
-            if c in event_fields.TIMESTAMP_FIELDS:
-                column_datatypes[c] = data_type.DataType.DATETIME
-            else:
-                column_datatypes[c] = data_type.DataType.STRING
-                df[c] = df[c].astype(str)
-        elif df[c].dtype == np.float64 or float == type(first_good_value):
-            column_datatypes[c] = data_type.DataType.FLOAT64
-        elif df[c].dtype == np.int64 or int == type(first_good_value):
-            column_datatypes[c] = data_type.DataType.INT64
-        elif df[c].dtype == np.bool_ or bool == type(first_good_value):
-            column_datatypes[c] = data_type.DataType.BOOLEAN
-        elif "datetime64" in str(df[c].dtype):
-            column_datatypes[c] = data_type.DataType.DATETIME
+        kind = dtypes[c].kind
+        if kind == "O":
+            values = df[c].to_numpy()
+            column_type = object_datatype(c, values)
+            if column_type is None:
+                continue
+            if column_type == data_type.DataType.STRING and c in event_fields.TIMESTAMP_FIELDS:
+                column_type = data_type.DataType.DATETIME
+            elif column_type == data_type.DataType.STRING \
+                    and pd.api.types.infer_dtype(values, skipna=False) != "string":
+                # Only columns with nulls or other values than strings change
+                to_str.append(c)
+        elif kind in "iu":
+            column_type = data_type.DataType.INT64
+        elif kind == "b":
+            column_type = data_type.DataType.BOOLEAN
+        elif kind in "fM":
+            if not df[c].notna().any():
+                continue
+            column_type = data_type.DataType.FLOAT64 if kind == "f" else data_type.DataType.DATETIME
         else:
-            raise Exception(
-                f"Unknown type. dtype= {df[c].dtype}. column = {c}, first value = {first_good_value}, Python Type = {type(first_good_value)} "
-            )
-
+            raise Exception(f"Unknown type. dtype= {dtypes[c]}. column = {c}")
+        column_datatypes[c] = column_type
+
+    if to_str:
+        strings = df[to_str].astype(str)
+        if keep_nulls:
+            # Nulls stay None instead of becoming "None"
+            strings = strings.where(df[to_str].notna(), None)
+        set_columns(df, [df.columns.get_loc(c) for c in to_str], strings)
     return column_datatypes
 
 
-def first_valid_value(df, column):
-    """Returns None if no valid value exists else returns value"""
-    valid_index = df[column].first_valid_index()
-    if valid_index is None:
+def object_datatype(column, values):
+    """Returns data type of object column values, None if it has no values"""
+    inferred = pd.api.types.infer_dtype(values, skipna=True)
+    if inferred == "empty":
+        return None
+    if inferred in INFERRED_DATATYPES:
+        return INFERRED_DATATYPES[inferred]
+
+    non_null = values[~pd.isna(values)]
+    counts = Counter(map(type, non_null))
+    if list in counts:
+        return array_datatype(column, non_null, counts)
+    if dict in counts:
+        # Other values of a map column can not be cast and become misfits
+        if len(counts) > 1:
+            logger.info(f"Column {column} has values of mixed types {dict(counts)}, using a map")
+            metrics.inc("mixed_columns")
+        return data_type.DataType.MAP
+    unknown = [t for t in counts if t not in INFERRED_PYTHON_TYPES.values()]
+    if unknown:
+        raise Exception(f"Unknown type. column = {column}, Python Types = {unknown}")
+    strings = counts[str]
+    numbers = sum(counts.values()) - strings
+    if strings > numbers:
+        column_type = data_type.DataType.STRING
+    elif float in counts:
+        column_type = data_type.DataType.FLOAT64
+    else:
+        column_type = data_type.DataType.INT64
+    logger.info(f"Column {column} has values of mixed types {dict(counts)}, using {column_type}")
+    metrics.inc("mixed_columns")
+    return column_type
+
+
+def array_datatype(column, non_null, counts):
+    """Returns array type of column holding lists by types of their elements, None if all lists are empty"""
+    if len(counts) > 1:
+        logger.info(f"Column {column} has values of mixed types {dict(counts)}, using an array")
+        metrics.inc("mixed_columns")
+    elements = list(chain.from_iterable(v if type(v) is list else (v,) for v in non_null))
+    inferred = pd.api.types.infer_dtype(elements, skipna=True)
+    if inferred == "empty":
         return None
-    logger.debug(
-        f"valid_index = {valid_index}, column = {column}, df[column][{valid_index}] = {df[column][valid_index]}"
-    )
-    return df[column][valid_index]
+    element_type = INFERRED_DATATYPES.get(inferred)
+    if element_type is None:
+        element_types = {type(e) for e in elements if e is not None}
+        if element_types <= {int, bool}:
+            element_type = data_type.DataType.INT64
+        elif element_types <= {int, bool, float}:
+            element_type = data_type.DataType.FLOAT64
+    return ELEMENT_ARRAY_DATATYPES.get(element_type, data_type.DataType.ARRAY)
+
+
+def pack_map_columns(df, map_columns):
+    """Returns df with columns of map_columns prefixes, other than hot columns, packed into a map per prefix"""
+    packed = {}
+    for column in df.columns:
+        if column in map_columns.hot_columns:
+            continue
+        for prefix in map_columns.prefixes:
+            if column.startswith(prefix):
+                packed.setdefault(prefix, []).append(column)
+                break
+    if not packed:
+        return df
+
+    df = df.copy(deep=False)
+    for prefix, columns in packed.items():
+        # Filled column by column, so that sparse columns cost only their values
+        maps = [{} for _ in range(row_count(df))]
+        for column in columns:
+            key = column[len(prefix):]
+            values = df[column].to_numpy()
+            positions = np.flatnonzero(pd.notna(values))
+            for position, value in zip(positions.tolist(), values[positions].tolist()):
+                maps[position][key] = string_value(value)
+            del df[column]
+        map_column = np.empty(row_count(df), dtype=object)
+        map_column[:] = maps
+        df[map_columns.map_column(prefix)] = map_column
+    return df
+
+
+def string_value(value):
+    """String of value in a map or an array of strings, booleans, lists and dicts are written like in JSON"""
+    if type(value) is str:
+        return value
+    if type(value) is bool:
+        return "true" if value else "false"
+    if type(value) is list or type(value) is dict:
+        return json.dumps(value, default=str)
+    if type(value) is float and value.is_integer():
+        # Integer columns with nulls are floats in data frames
+        return str(int(value))
+    return str(value)
 
 
 def row_count(df):
@@ -60,45 +220,138 @@ def empty(df):
     return row_count(df) == 0
 
 
+def partition_by(df, column, sort=False):
+    """Returns value -> rows of df with that value of column, rows with null value are dropped"""
+    if empty(df):
+        return {}
+    return {value: df.take(positions) for value, positions in df.groupby(column, sort=sort).indices.items()}
+
+
+def estimate_memory(df, sample_rows=MEMORY_SAMPLE_ROWS):
+    """Bytes held by df, python objects are measured in a sample of rows"""
+    rows = row_count(df)
+    if rows <= sample_rows:
+        return int(df.memory_usage(index=False, deep=True).sum())
+    shallow = df.memory_usage(index=False, deep=False).to_numpy()
+    is_object = (df.dtypes == object).to_numpy()
+    if not is_object.any():
+        return int(shallow.sum())
+    sample = df.iloc[::rows // sample_rows, np.flatnonzero(is_object)]
+    sample_bytes = sample.memory_usage(index=False, deep=True).sum()
+    return int(shallow[~is_object].sum() + sample_bytes * rows / row_count(sample))
+
+
 def mark_nan_to_none(df):
-    return df.where(pd.notnull(df), None)
+    """Replaces NaN with None in object columns in place and returns df"""
+    positions = []
+    replaced = {}
+    for position in np.flatnonzero((df.dtypes == object).to_numpy()):
+        values = df.iloc[:, position].to_numpy()
+        null = pd.isna(values)
+        if null.any():
+            values = values.copy()
+            values[null] = None
+            replaced[len(positions)] = values
+            positions.append(position)
+    if positions:
+        set_columns(df, positions, pd.DataFrame(replaced, index=df.index, dtype=object))
+    return df
+
+
+def set_columns(df, positions, values):
+    """Replaces columns of df at positions without writing into their arrays, which may be shared"""
+    if hasattr(df, "isetitem"):
+        # pandas >= 1.5 replaces all columns in one go
+        df.isetitem(positions, values)
+        return
+    for position, i in zip(positions, range(values.shape[1])):
+        set_column(df, df.columns[position], values.iloc[:, i].to_numpy())
+
+
+def set_column(df, column_name, values):
+    """Replaces column of df with values without writing into its array, which may be shared"""
+    position = df.columns.get_loc(column_name)
+    if hasattr(df, "isetitem"):
+        df.isetitem(position, values)
+        return
+    # pandas < 1.5 writes values into array of a column holding same dtype, also when df is a shallow copy,
+    # so column is deleted, which gives df arrays of its own, and inserted again at its position
+    del df[column_name]
+    df.insert(position, column_name, values)
 
 
 def mark_string_na_to_default(df, col_types):
     for column_name, column_type in col_types.items():
         if column_type == data_type.DataType.STRING:
-            df[column_name].fillna("_default", inplace=True)
+            df[column_name] = df[column_name].fillna("_default")
 
 
 def mark_int_na_to_default(df, col_types):
     for column_name, column_type in col_types.items():
         if column_type == data_type.DataType.INT64:
-            df[column_name].fillna(0, inplace=True)
+            df[column_name] = df[column_name].fillna(0)
 
 
 def mark_float_na_to_default(df, col_types):
     for column_name, column_type in col_types.items():
         if column_type in (data_type.DataType.FLOAT64, data_type.DataType.FLOAT32):
-            df[column_name].fillna(0.0, inplace=True)
+            df[column_name] = df[column_name].fillna(0.0)
 
 
 def cast_boolean_to_int(df, col_types):
     for column_name, column_type in col_types.items():
         if column_type == data_type.DataType.BOOLEAN:
-            df[column_name].fillna(False, inplace=True)
-            df[column_name] = df[column_name].astype(int)
+            # Column is replaced instead of filled in place, as df may share columns with data frame of caller
+            set_column(df, column_name, df[column_name].fillna(False).astype(int).to_numpy())
 
 
-def add_missing_columns(df, col_types):
-    existing_cols = get_datatypes(df)
+def add_missing_columns(df, col_types, existing_col_types=None):
+    """Sets columns of col_types missing in df or without values to None, empty maps or empty arrays"""
+    existing_cols = get_datatypes(df) if existing_col_types is None else existing_col_types
     for column_name, column_type in col_types.items():
         if column_name not in existing_cols:
-            df[column_name] = None
-
-
-def fix_data_types(df, df_dicts, expected_col_types):
-    """ Fixes data types and returns misfits if not able to fix """
-    df_col_types = get_datatypes(df)
+            if column_type == data_type.DataType.MAP:
+                values = filled(row_count(df), {})
+            elif column_type in data_type.ARRAY_DATATYPES:
+                values = filled(row_count(df), [])
+            else:
+                values = filled(row_count(df), None)
+            if column_name in df.columns:
+                # Column without values, which is replaced instead of filled
+                set_column(df, column_name, values)
+            else:
+                df[column_name] = values
+
+
+def filled(rows, value):
+    """Object column with value in every row. Value is shared by all rows, so it must never be changed."""
+    values = np.empty(rows, dtype=object)
+    values.fill(value)
+    return values
+
+
+def cast_to_table(dataframe, table_column_types, col_types=None):
+    """Returns dataframe cast to types of table columns and misfits of cells which could not be cast"""
+    # Data frame is shared by inserts of all warehouses. Casts replace columns of this shallow copy,
+    # so they never touch data of the shared one and only cast columns get copied.
+    df = dataframe.copy(deep=False)
+    if col_types is None:
+        col_types = get_datatypes(df)
+    cast_boolean_to_int(df, col_types)
+    col_types = {
+        c: data_type.DataType.INT64 if t == data_type.DataType.BOOLEAN else t for c, t in col_types.items()
+    }
+    # mark_int_na_to_default(df, col_types)
+    # mark_float_na_to_default(df, col_types)
+    add_missing_columns(df, table_column_types, col_types)
+    misfits = fix_data_types(df, table_column_types, col_types)
+    return df, misfits
+
+
+def fix_data_types(df, expected_col_types, df_col_types=None):
+    """Fixes data types of df columns in place and returns misfits if not able to fix"""
+    if df_col_types is None:
+        df_col_types = get_datatypes(df)
     misfits = []
 
     for column_name, column_type in expected_col_types.items():
@@ -109,14 +362,15 @@ def fix_data_types(df, df_dicts, expected_col_types):
             continue
         else:
             if expected_col_types[column_name] == data_type.DataType.STRING:
-                cast_to_str(column_name, df_dicts)
+                cast_to_str(df, column_name)
             elif expected_col_types[column_name] in data_type.INT_DATATYPES:
                 if df_col_types[column_name] in data_type.INT_DATATYPES and df[column_name].dtype == object:
-                    misfits = misfits + cast_to_int(column_name, df_dicts)
+                    misfits = misfits + cast_to_int(df, column_name)
                 elif df_col_types[column_name] in data_type.FLOAT_DATATYPES:
-                    misfits = misfits + cast_to_int(column_name, df_dicts)
-                elif df_col_types[column_name] == data_type.DataType.STRING:
-                    misfits = misfits + cast_to_int(column_name, df_dicts)
+                    misfits = misfits + cast_to_int(df, column_name)
+                elif df_col_types[column_name] in (data_type.DataType.STRING, data_type.DataType.MAP) \
+                        or df_col_types[column_name] in data_type.ARRAY_DATATYPES:
+                    misfits = misfits + cast_to_int(df, column_name)
                 elif df_col_types[column_name] in data_type.INT_DATATYPES:
                     # Let us hope similar integers will be handled wisely by downstream
                     continue
@@ -126,11 +380,12 @@ def fix_data_types(df, df_dicts, expected_col_types):
                     )
             elif expected_col_types[column_name] in data_type.FLOAT_DATATYPES:
                 if df_col_types[column_name] in data_type.FLOAT_DATATYPES and df[column_name].dtype == object:
-                    misfits = misfits + cast_to_float(column_name, df_dicts)
+                    misfits = misfits + cast_to_float(df, column_name)
                 elif df_col_types[column_name] in data_type.INT_DATATYPES:
-                    misfits = misfits + cast_to_float(column_name, df_dicts)
-                elif df_col_types[column_name] == data_type.DataType.STRING:
-                    misfits = misfits + cast_to_float(column_name, df_dicts)
+                    misfits = misfits + cast_to_float(df, column_name)
+                elif df_col_types[column_name] in (data_type.DataType.STRING, data_type.DataType.MAP) \
+                        or df_col_types[column_name] in data_type.ARRAY_DATATYPES:
+                    misfits = misfits + cast_to_float(df, column_name)
                 elif df_col_types[column_name] in data_type.FLOAT_DATATYPES:
                     # Let us hope similar integers will be handled wisely by downstream
                     continue
@@ -138,6 +393,11 @@ def fix_data_types(df, df_dicts, expected_col_types):
                     raise Exception(
                         f"Dont know how to handle. Column = {column_name}, Expected {expected_col_types[column_name]}, Actual {df_col_types[column_name]}"
                     )
+            elif expected_col_types[column_name] in data_type.ARRAY_DATATYPES:
+                misfits = misfits + cast_to_array(df, column_name, expected_col_types[column_name])
+            elif expected_col_types[column_name] == data_type.DataType.MAP:
+                # Rows of frames without the map column, e.g. of buffered batches, have None
+                misfits = misfits + cast_to_map(df, column_name)
             else:
                 raise Exception(
                     f"Dont know how to handle. Column = {column_name}, Expected {expected_col_types[column_name]}, Actual {df_col_types[column_name]}"
@@ -145,41 +405,192 @@ def fix_data_types(df, df_dicts, expected_col_types):
     return misfits
 
 
-def cast_to_float(column_name, df_dicts):
+def cast_to_map(df, column_name):
+    """Keeps maps of column, other cells become empty maps and non null ones are misfits"""
+    values = df[column_name].to_numpy(dtype=object)
+    null, masks = cell_type_masks(values, (dict,))
+    bad = ~null & ~masks[dict]
+    empty_maps = null | bad
+    if not empty_maps.any():
+        return []
+    misfits = get_misfits(df, column_name, bad, dict)
+    values = values.copy()
+    values[empty_maps] = filled(int(empty_maps.sum()), {})
+    set_column(df, column_name, values)
+    return misfits
+
+
+def cast_to_float(df, column_name):
+    """ Casts column to float in bulk. Cells which can not be cast are set to None and returned as misfits"""
+    values = df[column_name].to_numpy(dtype=object, copy=True)
+    null, masks = cell_type_masks(values, (int, float, bool, str))
+    is_number = masks[int] | masks[float] | masks[bool]
+    is_str = masks[str]
+
+    ok = is_number.copy()
+    if is_number.any():
+        values[is_number] = values[is_number].astype(float).astype(object)
+    if is_str.any():
+        str_ok, parsed = parse_float_strings(values[is_str])
+        positions = np.flatnonzero(is_str)[str_ok]
+        values[positions] = parsed
+        ok[positions] = True
+
+    bad = ~null & ~ok
+    return set_cast_values(df, column_name, values, null, bad, float)
+
+
+def cast_to_array(df, column_name, column_type):
+    """Casts cells to lists of elements of column_type, returns misfits of elements which can not be cast"""
+    python_type = ARRAY_ELEMENT_TYPES[column_type]
+    values = df[column_name].to_numpy(dtype=object, copy=True)
+    null = pd.isna(values)
+    message_ids = df['message_id'].to_numpy()
     misfits = []
-    for d in df_dicts:
-        if d[column_name] is not None:
-            try:
-                d[column_name] = float(d[column_name])
-            except ValueError:
-                misfits.append({'message_id': d['message_id'],
+    for i in range(len(values)):
+        value = values[i]
+        if null[i]:
+            values[i] = []
+            continue
+        if type(value) is not list:
+            value = [value]
+        elif all(type(e) is python_type or e is None for e in value):
+            continue
+        cast = []
+        for element in value:
+            ok, cast_element = cast_array_element(element, python_type)
+            if not ok:
+                misfits.append({'message_id': message_ids[i],
                                 'column_name': column_name,
-                                'column_value': d[column_name],
-                                'expected_data_type': str(float),
-                                'actual_data_type': str(type(d[column_name]))
-                                })
-                d[column_name] = None
+                                'column_value': string_value(element),
+                                'expected_data_type': str(python_type),
+                                'actual_data_type': str(type(element))})
+            cast.append(cast_element)
+        values[i] = cast
+    set_column(df, column_name, values)
     return misfits
 
 
-def cast_to_str(column_name, df_dicts):
-    for d in df_dicts:
-        if d[column_name] is not None:
-            d[column_name] = str(d[column_name])
+def cast_array_element(element, python_type):
+    """Returns whether element could be cast to python_type and cast element, None if it could not"""
+    if element is None:
+        return True, None
+    if python_type is str:
+        return True, string_value(element)
+    try:
+        return True, python_type(element)
+    except (ValueError, TypeError, OverflowError):
+        return False, None
+
+
+def cast_to_str(df, column_name):
+    values = df[column_name].to_numpy(dtype=object, copy=True)
+    null, masks = cell_type_masks(values, (list, dict))
+    # Lists and maps are written like in JSON instead of as python repr
+    nested = masks[list] | masks[dict]
+    plain = ~null & ~nested
+    values[plain] = pd.Series(values[plain], dtype=object).astype(str).to_numpy()
+    if nested.any():
+        values[nested] = [string_value(v) for v in values[nested]]
+    values[null] = None
+    set_column(df, column_name, values)
+
+
+def cast_to_int(df, column_name):
+    """ Casts column to int in bulk. Cells which can not be cast are set to None and returned as misfits"""
+    values = df[column_name].to_numpy(dtype=object, copy=True)
+    null, masks = cell_type_masks(values, (int, float, bool, str))
+    is_bool = masks[bool]
+    is_float = masks[float]
+    is_str = masks[str]
+
+    ok = masks[int] | is_bool
+    if is_bool.any():
+        values[is_bool] = values[is_bool].astype(int).astype(object)
+
+    if is_float.any():
+        float_positions = np.flatnonzero(is_float)
+        floats = values[float_positions].astype(float)
+        finite = np.isfinite(floats)
+        fits = finite & (np.abs(floats) < 2 ** 63)
+        values[float_positions[fits]] = np.trunc(floats[fits]).astype(np.int64).astype(object)
+        values[float_positions[finite & ~fits]] = [int(f) for f in floats[finite & ~fits]]
+        ok[float_positions[finite]] = True
+
+    if is_str.any():
+        str_ok, parsed = parse_int_strings(values[is_str])
+        positions = np.flatnonzero(is_str)[str_ok]
+        values[positions] = parsed
+        ok[positions] = True
+
+    bad = ~null & ~ok
+    return set_cast_values(df, column_name, values, null, bad, int)
+
+
+def parse_int_strings(strings):
+    """ Returns mask of strings which are integers and their python int values """
+    return parse_strings(strings, int, np.int64)
+
+
+def parse_float_strings(strings):
+    """ Returns mask of strings which are floats and their python float values """
+    return parse_strings(strings, float, np.float64)
+
+
+def parse_strings(strings, python_type, numpy_type):
+    """Returns mask of strings parsed as python_type and their values, parsing chunks in C"""
+    parsed = np.empty(len(strings), dtype=object)
+    ok = np.zeros(len(strings), dtype=bool)
+    for start in range(0, len(strings), PARSE_CHUNK_SIZE):
+        end = start + PARSE_CHUNK_SIZE
+        try:
+            parsed[start:end] = strings[start:end].astype(numpy_type).astype(object)
+            ok[start:end] = True
+        except (ValueError, OverflowError):
+            for i in range(start, min(end, len(strings))):
+                try:
+                    parsed[i] = python_type(strings[i])
+                    ok[i] = True
+                except ValueError:
+                    pass
+    return ok, parsed[ok]
+
+
+def cell_type_masks(values, python_types):
+    """ Returns mask of null cells (None, NaN, NaT) and mask of non null cells of each python type """
+    null = pd.isna(values)
+    masks = {t: np.zeros(len(values), dtype=bool) for t in python_types}
+    non_null = values[~null]
+    # infer_dtype stops at first mismatch, so columns with a single type skip per cell type lookup
+    single_type = INFERRED_PYTHON_TYPES.get(pd.api.types.infer_dtype(non_null, skipna=False))
+    if single_type is not None:
+        if single_type in masks:
+            masks[single_type] = ~null
+        return null, masks
+
+    codes, cell_types = pd.factorize(pd.Series(non_null, dtype=object).map(type))
+    non_null_positions = np.flatnonzero(~null)
+    for code, cell_type in enumerate(cell_types):
+        if cell_type in masks:
+            masks[cell_type][non_null_positions[codes == code]] = True
+    return null, masks
+
+
+def set_cast_values(df, column_name, values, null, bad, python_type):
+    """ Sets cast values to df column. Null and bad cells become None. Returns misfits for bad cells"""
+    misfits = get_misfits(df, column_name, bad, python_type)
+    values[null | bad] = None
+    set_column(df, column_name, values)
+    return misfits
 
 
-def cast_to_int(column_name, df_dicts):
-    misfits = []
-    for d in df_dicts:
-        if d[column_name] is not None:
-            try:
-                d[column_name] = int(d[column_name])
-            except ValueError:
-                misfits.append({'message_id': d['message_id'],
-                                'column_name': column_name,
-                                'column_value': d[column_name],
-                                'expected_data_type': str(int),
-                                'actual_data_type': str(type(d[column_name]))
-                                })
-                d[column_name] = None
-    return misfits
+def get_misfits(df, column_name, bad, python_type):
+    """ Returns misfits for bad cells of column, which could not be cast to python_type"""
+    message_ids = df['message_id'].to_numpy()[bad]
+    bad_values = df[column_name].to_numpy(dtype=object)[bad]
+    return [{'message_id': message_id,
+             'column_name': column_name,
+             'column_value': value if type(value) is str else string_value(value),
+             'expected_data_type': str(python_type),
+             'actual_data_type': str(type(value))
+             } for message_id, value in zip(message_ids, bad_values)]
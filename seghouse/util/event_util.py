@@ -0,0 +1,27 @@
+from functools import lru_cache
+
+import humps
+import pandas as pd
+
+from ..config import default_table_structure
+
+EVENT_NAME_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=EVENT_NAME_CACHE_SIZE)
+def normalize_event_name(event):
+    """Event name as stored in event column, e.g. "Add & Remove" -> "addand_remove" """
+    return humps.decamelize(event.replace(" ", "").replace("&", "and")).lower()
+
+
+@lru_cache(maxsize=EVENT_NAME_CACHE_SIZE)
+def event_table_name(event):
+    """Table of a normalized event name. Events named like default tables get esc_ prefix."""
+    if event in default_table_structure.DEFAULT_TABLES:
+        return f"esc_{event}"
+    return event
+
+
+def normalize_event_names(events: pd.Series):
+    """Normalizes every distinct event name once and maps results back to rows"""
+    return events.map({event: normalize_event_name(event) for event in events.unique()})
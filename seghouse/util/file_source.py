@@ -0,0 +1,150 @@
+import itertools
+import logging
+import os
+import shutil
+import threading
+import uuid
+from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from os import listdir
+from os.path import isfile, join
+from typing import List
+
+from . import aws_wrapper
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SourceFile:
+    """File listed by a FileSource"""
+
+    name: str
+    size: int
+
+
+class FileSource(metaclass=ABCMeta):
+    """Abstract source of event files"""
+
+    @abstractmethod
+    def location(self) -> str:
+        """Directory or S3 prefix files are listed from"""
+        return ""
+
+    @abstractmethod
+    def list_files(self) -> List[SourceFile]:
+        return []
+
+    @abstractmethod
+    def fetch(self, source_file: SourceFile) -> str:
+        """Returns local path of file, fetching it if needed"""
+        return ""
+
+    def release(self, source_file: SourceFile, local_path: str):
+        """Called once file is ingested"""
+        return
+
+    def close(self):
+        return
+
+
+class LocalDirSource(FileSource):
+    """Files of a local directory. Files are never deleted."""
+
+    def __init__(self, source_dir: str):
+        self.source_dir = source_dir
+
+    def location(self):
+        return os.path.abspath(self.source_dir)
+
+    def list_files(self):
+        return [
+            SourceFile(f, os.path.getsize(join(self.source_dir, f)))
+            for f in sorted(listdir(self.source_dir)) if isfile(join(self.source_dir, f))
+        ]
+
+    def fetch(self, source_file):
+        return self.source_dir + "/" + source_file.name
+
+
+class S3Source(FileSource):
+    """
+    Files of a S3 directory. Each file is downloaded on fetch and deleted on release.
+    endpoint_url can point to a local S3 stand-in like MinIO.
+    """
+
+    def __init__(self, s3_dir: str, endpoint_url: str = None):
+        self.s3_dir = s3_dir.rstrip("/")
+        self.endpoint_url = endpoint_url
+        local_dir_name = str(uuid.uuid4()).replace("-", "")
+        self.local_dir = f"/tmp/{aws_wrapper.TMP_DIR_PREFIX}-{local_dir_name}"
+        os.makedirs(self.local_dir, exist_ok=True)
+
+    def location(self):
+        return self.s3_dir
+
+    def list_files(self):
+        return [SourceFile(name, size) for name, size in aws_wrapper.s3_list(self.s3_dir, self.endpoint_url)]
+
+    def fetch(self, source_file):
+        local_path = f"{self.local_dir}/{source_file.name}"
+        aws_wrapper.s3_copy_file(f"{self.s3_dir}/{source_file.name}", local_path, self.endpoint_url)
+        return local_path
+
+    def release(self, source_file, local_path):
+        logger.info(f"Removing {local_path}")
+        os.remove(local_path)
+
+    def close(self):
+        logger.info(f"Removing directory {self.local_dir}")
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+
+
+class Prefetcher:
+    """
+    Iterates over (source file, local path) in listing order while next files are fetched in background.
+    At most window files are fetched and not yet released at any time, which bounds local disk usage.
+    """
+
+    def __init__(self, source: FileSource, source_files: List[SourceFile], window: int):
+        self.source = source
+        self.source_files = source_files
+        self.window = max(window, 1)
+        self.slots = threading.Semaphore(self.window)
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=self.window, thread_name_prefix="seghouse-prefetch")
+
+    def __iter__(self):
+        remaining = iter(self.source_files)
+        pending = deque(
+            (source_file, self.executor.submit(self.fetch, source_file))
+            for source_file in itertools.islice(remaining, self.window)
+        )
+        while pending:
+            source_file, future = pending.popleft()
+            local_path = future.result()
+            for next_file in itertools.islice(remaining, 1):
+                pending.append((next_file, self.executor.submit(self.fetch, next_file)))
+            yield source_file, local_path
+
+    def fetch(self, source_file):
+        # Wait for an ingested file to be released before fetching one more
+        while not self.slots.acquire(timeout=1):
+            if self.closed:
+                raise Exception("Prefetcher is closed")
+        try:
+            logger.info(f"Fetching {source_file.name}")
+            return self.source.fetch(source_file)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, source_file, local_path):
+        self.source.release(source_file, local_path)
+        self.slots.release()
+
+    def close(self):
+        self.closed = True
+        self.executor.shutdown(wait=True)
@@ -1,3 +1,21 @@
+import importlib
+import json
+import logging
+from functools import lru_cache
+
+import humps
+
+logger = logging.getLogger(__name__)
+
+KEY_CACHE_SIZE = 65536
+# auto picks the first installed backend of FAST_JSON_BACKENDS and falls back to stdlib json
+JSON_BACKENDS = ["auto", "orjson", "json"]
+FAST_JSON_BACKENDS = ["orjson"]
+# Integers of 19 or more digits may not fit in 64 bits, which orjson decodes as floats
+WIDE_INT_DIGITS = 19
+ZERO_DIGITS = bytes.maketrans(b"123456789", b"000000000")
+
+
 def flatten_json(y):
     out = {}
 
@@ -20,5 +38,137 @@ def flatten_json(y):
     return out
 
 
+def flatten_event(event, arrays=False):
+    """
+    Decamelizes, cleans and flattens event in a single walk.
+    Returns same result as flatten_json(humps.decamelize(event)), unless arrays is set.
+    With arrays lists are kept as lists, see flatten_list, instead of becoming a column per position.
+    """
+    out = {}
+    stack = [(event, None)]
+    while stack:
+        x, name = stack.pop()
+        if type(x) is dict:
+            # Reversed so that columns come out in the same order as flatten_json
+            for a in reversed(list(x)):
+                stack.append((x[a], child_column_name(name, a)))
+        elif type(x) is list and arrays:
+            out.update(flatten_list(x, name or ""))
+        elif type(x) is list:
+            for i in range(len(x) - 1, -1, -1):
+                stack.append((x[i], child_column_name(name, i)))
+        else:
+            out[name or ""] = x
+    return out
+
+
+def flatten_list(values, name):
+    """
+    Returns columns of list named name. A list of scalars is a column holding the list.
+    A list of objects becomes parallel lists, a column per key of its objects with value of key in every
+    object and None where it is missing, e.g. products: [{sku: a}, {sku: b, price: 1}] becomes
+    products_sku: [a, b] and products_price: [None, 1]. Lists within lists are JSON encoded.
+    """
+    if not any(type(v) is dict for v in values):
+        return {name: [json.dumps(v) if type(v) is list else v for v in values]}
+    columns = {}
+    for i, value in enumerate(values):
+        stack = [(value, name)]
+        while stack:
+            x, column = stack.pop()
+            if type(x) is dict:
+                for a in reversed(list(x)):
+                    stack.append((x[a], child_column_name(column, a)))
+                continue
+            if type(x) is list:
+                x = json.dumps(x)
+            if column not in columns:
+                columns[column] = [None] * len(values)
+            columns[column][i] = x
+    return columns
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def child_column_name(parent, key):
+    """Translates raw key under already translated parent column name to final column name"""
+    if type(key) is int:
+        part = str(key)
+    else:
+        part = clean_event_key(humps.decamelize(key))
+    if parent is None:
+        return part
+    return f"{parent}_{part}"
+
+
 def clean_event_key(key):
     return key.strip().replace(" ", "").replace(":", "_").replace("-", "_")
+
+
+@lru_cache()
+def get_loads(backend="auto"):
+    """Returns loads function of given JSON backend"""
+    if backend not in JSON_BACKENDS:
+        raise Exception(f"Unknown JSON backend {backend}. Supported backends are {JSON_BACKENDS}")
+    for name in FAST_JSON_BACKENDS if backend == "auto" else [backend]:
+        try:
+            loads = importlib.import_module(name).loads
+            logger.info(f"Using {name} to decode JSON")
+            return loads
+        except ImportError as e:
+            if backend != "auto":
+                raise Exception(f"JSON backend {backend} is not installed, install it with "
+                                f"pip install 'seghouse[{backend}]': {e!r}") from e
+    logger.info(f"Using json to decode JSON")
+    return json.loads
+
+
+def loads_lines(lines, loads=json.loads):
+    """
+    Decodes NDJSON lines (bytes) with a single loads call by wrapping them in a JSON array.
+    Falls back to line by line decoding when that fails, e.g. for a bad line, and when lines may have
+    integers beyond 64 bits, so that only those lines are decoded by stdlib json.
+    """
+    document = b"[" + b",".join(lines) + b"]"
+    if loads is json.loads or not has_wide_int(document):
+        try:
+            decoded = loads(document)
+            if len(decoded) == len(lines):
+                return decoded
+        except ValueError:
+            pass
+    return [loads_line(line, loads) for line in lines]
+
+
+def loads_line(line, loads=json.loads):
+    """
+    Decodes line, falling back to stdlib json for what loads rejects, e.g. NaN,
+    and for lines with integers loads may decode as floats.
+    """
+    if loads is json.loads or has_wide_int(line):
+        return json.loads(line)
+    try:
+        return loads(line)
+    except ValueError:
+        return json.loads(line)
+
+
+def has_wide_int(document):
+    """
+    Whether JSON document (bytes) may have an integer value of WIDE_INT_DIGITS or more digits.
+    Runs of digits are found on a copy with all digits zeroed, as scanning for them with re is slow,
+    and only runs following a colon, comma or bracket are numbers rather than parts of strings.
+    """
+    digits = document.translate(ZERO_DIGITS)
+    run = b"0" * WIDE_INT_DIGITS
+    start = digits.find(run)
+    while start != -1:
+        end = start + WIDE_INT_DIGITS
+        while digits[end:end + 1] == b"0":
+            end += 1
+        before = start - 1
+        while before >= 0 and document[before] in b" \t\r\n-":
+            before -= 1
+        if before >= 0 and document[before] in b":,[" and document[end:end + 1] not in (b".", b"e", b"E"):
+            return True
+        start = digits.find(run, end)
+    return False
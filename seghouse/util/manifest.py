@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict
+
+from .file_source import SourceFile
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+class IngestManifest:
+    """
+    Persistent record of files sent to warehouses, kept in a local SQLite database.
+    A file is identified by namespace, location of its source, name and size,
+    so it is known to be sent before fetching it.
+    Files recorded before locations were kept have an empty location and match any location.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = os.path.expanduser(file_path)
+        directory = os.path.dirname(self.file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.file_path)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(ingested_files)")]
+        if columns and "location" not in columns:
+            logger.info(f"Adding location of files to manifest {self.file_path}")
+            self.connection.execute("ALTER TABLE ingested_files RENAME TO ingested_files_without_location")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS ingested_files (
+                namespace TEXT NOT NULL,
+                location TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                rows TEXT NOT NULL,
+                ingested_at TEXT NOT NULL,
+                PRIMARY KEY (namespace, location, name, size)
+            )"""
+        )
+        if columns and "location" not in columns:
+            self.connection.execute(
+                "INSERT INTO ingested_files SELECT namespace, '', name, size, checksum, rows, ingested_at "
+                "FROM ingested_files_without_location"
+            )
+            self.connection.execute("DROP TABLE ingested_files_without_location")
+        self.connection.commit()
+
+    def contains(self, namespace: str, location: str, source_file: SourceFile):
+        cursor = self.connection.execute(
+            "SELECT 1 FROM ingested_files WHERE namespace = ? AND location IN (?, '') AND name = ? AND size = ?",
+            (namespace, location, source_file.name, source_file.size),
+        )
+        return cursor.fetchone() is not None
+
+    def record(self, namespace: str, location: str, source_file: SourceFile, checksum: str, rows: Dict[str, int]):
+        logger.info(f"Recording {source_file.name} of {location} in manifest {self.file_path}")
+        self.connection.execute(
+            "INSERT OR REPLACE INTO ingested_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                namespace,
+                location,
+                source_file.name,
+                source_file.size,
+                checksum,
+                json.dumps(rows, sort_keys=True),
+                datetime.now(timezone.utc).isoformat(),
+            ),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def file_checksum(file_path: str):
+    """MD5 of file content"""
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
@@ -0,0 +1,97 @@
+import logging
+import threading
+from typing import Dict
+
+from . import dataframe_util
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+MAX_RSS = "max rss"
+# Memory used by a batch while it is transformed and inserted, relative to its data frame
+WORKING_COPIES = 3
+# Data frame bytes per raw NDJSON byte, until a batch is measured
+DEFAULT_FRAME_BYTES_RATIO = 4.0
+# Rows of first parquet batch, until a batch is measured
+DEFAULT_BATCH_ROWS = 65536
+MIN_BATCH_BYTES = 64 * 1024
+MIN_BATCH_ROWS = 1000
+
+
+class MemoryTracker:
+    """
+    Tracks peak bytes of data held by each stage of a job.
+    With a max_memory_mb budget it also sizes batches and write buffer so that batches in flight fit in budget.
+    Size of data frames per raw byte and per row is learned from batches read, so batches shrink for wide events.
+    0 means no budget.
+    """
+
+    def __init__(self, max_memory_mb: float = 0, batches_in_flight: int = 1, buffered: bool = False):
+        self.budget = int(max_memory_mb * MB)
+        # Half of budget is left to write buffer when rows are buffered, shared by buffered rows of all tables
+        self.batch_budget = self.budget // 2 if buffered else self.budget
+        self.buffer_budget = self.budget - self.batch_budget
+        self.batches_in_flight = max(batches_in_flight, 1)
+        self.frame_bytes_ratio = None
+        self.row_bytes = None
+        self.lock = threading.Lock()
+        self.peaks: Dict[str, int] = {}
+
+    def frame_bytes(self):
+        """Largest data frame of a batch which fits in budget"""
+        return self.batch_budget // (self.batches_in_flight * WORKING_COPIES)
+
+    def batch_bytes(self, configured: int):
+        """Raw bytes per NDJSON batch, at most configured ones"""
+        if not self.budget:
+            return configured
+        limit = max(int(self.frame_bytes() / (self.frame_bytes_ratio or DEFAULT_FRAME_BYTES_RATIO)), MIN_BATCH_BYTES)
+        return min(configured, limit) if configured else limit
+
+    def batch_rows(self, configured: int):
+        """Rows per parquet batch, at most configured ones"""
+        if not self.budget:
+            return configured
+        limit = DEFAULT_BATCH_ROWS if self.row_bytes is None else max(self.frame_bytes() // self.row_bytes,
+                                                                      MIN_BATCH_ROWS)
+        return min(configured, limit) if configured else limit
+
+    def buffer_bytes(self, configured: int):
+        """Bytes of write buffer per table, at most configured ones"""
+        if not self.buffer_budget:
+            return configured
+        return min(configured, self.buffer_budget) if configured else self.buffer_budget
+
+    def observe_batch(self, df, raw_bytes: int = 0):
+        """Measures data frame of a batch read from raw_bytes of file"""
+        frame_bytes = dataframe_util.estimate_memory(df)
+        rows = dataframe_util.row_count(df)
+        with self.lock:
+            # Largest seen so far, so that a file of narrow events does not let next wide ones overrun budget
+            if raw_bytes:
+                self.frame_bytes_ratio = max(self.frame_bytes_ratio or 0, frame_bytes / raw_bytes)
+            if rows:
+                self.row_bytes = max(self.row_bytes or 0, frame_bytes // rows + 1)
+        self.observe("read", frame_bytes)
+        return frame_bytes
+
+    def observe(self, stage: str, nbytes: int):
+        with self.lock:
+            if nbytes > self.peaks.get(stage, 0):
+                self.peaks[stage] = nbytes
+
+    def stage_peaks(self):
+        """Peak bytes per stage, including peak resident memory of this process"""
+        self.observe(MAX_RSS, max_rss())
+        with self.lock:
+            return dict(self.peaks)
+
+
+def max_rss():
+    """Peak resident memory of this process in bytes, 0 if not known on this platform"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
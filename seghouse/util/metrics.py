@@ -0,0 +1,218 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from tabulate import tabulate
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = "seghouse_"
+# Upper bounds of timing histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclass()
+class Histogram:
+    """Timings counted per bucket of BUCKETS. Last count is for timings above largest bucket."""
+
+    counts: List[int] = field(default_factory=lambda: [0] * (len(BUCKETS) + 1))
+    count: int = 0
+    sum: float = 0.0
+    max: float = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "Histogram"):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float):
+        """Estimates q quantile by interpolating within its bucket, like histogram_quantile of Prometheus"""
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(BUCKETS, self.counts):
+            if count and seen + count >= rank:
+                return min(lower + (bound - lower) * (rank - seen) / count, self.max)
+            seen += count
+            lower = bound
+        return self.max
+
+
+class Metrics:
+    """
+    Counters, gauges and timing histograms of a process, each identified by name and labels like table.
+    Snapshots of worker processes are merged into metrics of main process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, to_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[(name, to_labels(labels))] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, to_labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Observes time taken by block, also when it fails"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """Returns picklable copy of metrics, to be merged by another process"""
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {key: Histogram(list(h.counts), h.count, h.sum, h.max)
+                               for key, h in self.histograms.items()},
+            }
+
+    def merge(self, snapshot: dict):
+        with self.lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in snapshot["gauges"].items():
+                self.gauges[key] = max(self.gauges.get(key, value), value)
+            for key, histogram in snapshot["histograms"].items():
+                self.histograms.setdefault(key, Histogram()).merge(histogram)
+
+    def summary(self):
+        snapshot = self.snapshot()
+        counters = tabulate(
+            [(name, format_labels(labels), value) for (name, labels), value in sorted(snapshot["counters"].items())],
+            headers=["counter", "labels", "value"],
+        )
+        timings = tabulate(
+            [
+                (name, format_labels(labels), h.count, round(h.sum, 3), round(h.sum / h.count, 4),
+                 round(h.quantile(0.5), 4), round(h.quantile(0.95), 4), round(h.max, 4))
+                for (name, labels), h in sorted(snapshot["histograms"].items()) if h.count
+            ],
+            headers=["timing", "labels", "count", "total s", "mean s", "p50 s", "p95 s", "max s"],
+        )
+        return f"{counters}\n{timings}"
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        return {
+            "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in snapshot["counters"].items()],
+            "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in snapshot["gauges"].items()],
+            "histograms": [
+                {"name": n, "labels": dict(l), "count": h.count, "sum": h.sum, "max": h.max,
+                 "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], cumulative(h.counts)))}
+                for (n, l), h in snapshot["histograms"].items()
+            ],
+        }
+
+    def to_prometheus(self):
+        """Metrics in Prometheus text format, as read by textfile collector of node exporter"""
+        snapshot = self.snapshot()
+        lines = []
+        for metric_type, suffix, values in [("counter", "_total", snapshot["counters"]), ("gauge", "", snapshot["gauges"])]:
+            for name in sorted({n for n, _ in values}):
+                metric = f"{PROMETHEUS_PREFIX}{name}{suffix}"
+                lines.append(f"# TYPE {metric} {metric_type}")
+                for (n, labels), value in sorted(values.items()):
+                    if n == name:
+                        lines.append(f"{metric}{prometheus_labels(labels)} {value}")
+        histograms = snapshot["histograms"]
+        for name in sorted({n for n, _ in histograms}):
+            metric = f"{PROMETHEUS_PREFIX}{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip([str(b) for b in BUCKETS] + ["+Inf"], cumulative(h.counts)):
+                    lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{metric}_sum{prometheus_labels(labels)} {h.sum}")
+                lines.append(f"{metric}_count{prometheus_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, file_path: str):
+        """Writes metrics in Prometheus text format if file_path ends with .prom and as JSON otherwise"""
+        file_path = os.path.expanduser(file_path)
+        if file_path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_json(), indent=2)
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Renamed into place, so that a collector never reads a partial file
+        tmp_path = os.path.join(directory, f".{os.path.basename(file_path)}.{uuid.uuid4().hex}")
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+        logger.info(f"Wrote metrics to {file_path}")
+
+
+def to_labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels: Labels):
+    return ", ".join(f"{k}={v}" for k, v in labels)
+
+
+def prometheus_labels(labels: Labels):
+    if not labels:
+        return ""
+    escaped = (k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def cumulative(counts: List[int]):
+    total = 0
+    result = []
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+# Metrics of this process
+registry = Metrics()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
@@ -0,0 +1,165 @@
+import contextlib
+import cProfile
+import glob
+import hashlib
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict
+
+from tabulate import tabulate
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FILE = "summary.txt"
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 30
+# Since python 3.12 profilers use sys.monitoring, so only one of them can be enabled in a process at a time
+# and it sees calls of all threads
+SINGLE_PROFILER = sys.version_info >= (3, 12)
+
+
+@dataclass()
+class FileProfile:
+    """
+    Profiles of a file, one per thread which worked on it, as a profiler only sees calls of its own thread
+    before python 3.12. With SINGLE_PROFILER a file has one profile of all threads.
+    """
+
+    profiles: Dict[str, cProfile.Profile] = field(default_factory=dict)
+    snapshot: tracemalloc.Snapshot = None
+
+
+class FileProfiler:
+    """
+    Profiles processing of a share of files given by rate, with cProfile and optionally tracemalloc.
+    Files are sampled by a hash of their name, so all stages and worker processes agree on sampled files
+    and a rerun profiles the same files.
+    For every sampled file <name>.prof (pstats), <name>.txt (hot functions) and, with memory,
+    <name>.memory.txt (allocations made while file was processed) are written to directory.
+    """
+
+    def __init__(self, directory: str, rate: float = 1.0, memory: bool = False):
+        self.directory = directory
+        self.rate = rate
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.files: Dict[str, FileProfile] = {}
+        self.disabled = False
+        # Profiles enabled right now, at most one with SINGLE_PROFILER
+        self.active = 0
+        # Whether tracemalloc was started by profiler, and so is stopped by it
+        self.tracing = False
+
+    def enabled(self):
+        return bool(self.directory) and self.rate > 0
+
+    def sampled(self, file_path: str):
+        if not self.enabled():
+            return False
+        digest = hashlib.md5(os.path.basename(file_path).encode()).digest()
+        return int.from_bytes(digest[:4], "big") / 2 ** 32 < self.rate
+
+    def start(self, file_path: str):
+        if not self.sampled(file_path):
+            return
+        logger.info(f"Profiling {file_path}")
+        with self.lock:
+            file_profile = self.files.setdefault(file_path, FileProfile())
+            if self.memory:
+                # Allocations are traced process wide while any sampled file is processed
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.tracing = True
+                file_profile.snapshot = tracemalloc.take_snapshot()
+
+    @contextlib.contextmanager
+    def profile(self, file_path: str):
+        """
+        Profiles calls of current thread made in block, if file is sampled.
+        With SINGLE_PROFILER calls of all threads are profiled, and a block starting while a block of another
+        stage or file is profiled is not profiled, so that stages of a file take turns instead of failing.
+        """
+        with self.lock:
+            file_profile = self.files.get(file_path)
+            if file_profile is None or self.disabled or (SINGLE_PROFILER and self.active):
+                profile = None
+            else:
+                thread = "all threads" if SINGLE_PROFILER else threading.current_thread().name
+                profile = file_profile.profiles.setdefault(thread, cProfile.Profile())
+                try:
+                    profile.enable()
+                    self.active += 1
+                except ValueError as e:
+                    # Another profiler, e.g. of a debugger, is enabled in process
+                    logger.warning(f"Unable to profile, disabling profiler. error = {e!r}")
+                    self.disabled = True
+                    profile = None
+        if profile is None:
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.active -= 1
+
+    def finish(self, file_path: str):
+        """Writes profiles of file once all its stages are done with it"""
+        with self.lock:
+            file_profile = self.files.pop(file_path, None)
+            snapshot = None
+            peak = 0
+            if file_profile is not None and file_profile.snapshot is not None:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+            if self.tracing and not self.files:
+                tracemalloc.stop()
+                self.tracing = False
+        if file_profile is None or not file_profile.profiles:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, os.path.basename(file_path))
+        stats = None
+        for profile in file_profile.profiles.values():
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        stats.dump_stats(f"{base}.prof")
+        with open(f"{base}.txt", "w") as f:
+            f.write(f"Hot functions of {file_path} in threads {sorted(file_profile.profiles)}\n")
+            pstats.Stats(f"{base}.prof", stream=f).sort_stats("tottime").print_stats(TOP_FUNCTIONS)
+        if snapshot is not None:
+            with open(f"{base}.memory.txt", "w") as f:
+                f.write(f"Allocations made while {file_path} was processed, peak traced = {peak} bytes\n")
+                for diff in snapshot.compare_to(file_profile.snapshot, "lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{diff}\n")
+        logger.info(f"Wrote profile of {file_path} to {base}.prof")
+
+    def summary(self, top: int = 20):
+        """Ranks functions by time spent in them across all profiled files in directory, also of other workers"""
+        if not self.enabled():
+            return None
+        prof_files = sorted(glob.glob(os.path.join(self.directory, "*.prof")))
+        if not prof_files:
+            return None
+        stats = pstats.Stats(*prof_files, stream=io.StringIO())
+        rows = [
+            (pstats.func_std_string(func), calls, round(tottime, 3), round(cumtime, 3))
+            for func, (_, calls, tottime, cumtime, _) in stats.stats.items()
+        ]
+        rows.sort(key=lambda r: r[2], reverse=True)
+        table = tabulate(rows[:top], headers=["function", "calls", "self s", "cumulative s"])
+        summary = f"Hot functions of {len(prof_files)} profiled files\n{table}"
+        with open(os.path.join(self.directory, SUMMARY_FILE), "w") as f:
+            f.write(summary + "\n")
+        return summary
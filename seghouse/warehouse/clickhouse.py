@@ -1,13 +1,16 @@
 import logging
-from typing import Set, List
+import threading
+from typing import Collection, Dict, Set, List
 
-from clickhouse_driver import Client
+from clickhouse_driver import Client, errors
 
+from .clickhouse_pool import ConnectionPool
+from .schema_cache import SchemaCache
 from .warehouse import Warehouse
-from ..config.data_type import DataType
+from ..config.data_type import ARRAY_DATATYPES, FLOAT_DATATYPES, INT_DATATYPES, DataType
 from ..config import default_table_structure
 
-from ..util import dataframe_util
+from ..util import dataframe_util, metrics
 
 logger = logging.getLogger(__name__)
 
@@ -30,43 +33,92 @@ DT_TO_CH_DT = {
     DataType.STRING: "String",
     DataType.DATE: "Date",
     DataType.DATETIME: "DateTime",
+    DataType.MAP: "Map(String, String)",
+    DataType.ARRAY: "Array(Nullable(String))",
+    DataType.ARRAY_INT64: "Array(Nullable(Int64))",
+    DataType.ARRAY_FLOAT64: "Array(Nullable(Float64))",
 }
+# Types which ClickHouse does not allow in Nullable, their columns hold empty values instead of nulls
+NON_NULLABLE_DATATYPES = (DataType.MAP,) + ARRAY_DATATYPES
+# Query settings which can be set per warehouse in config
+CLIENT_SETTINGS = ["insert_block_size", "max_insert_threads", "allow_experimental_map_type"]
+# Errors which mean that cached schema of table is not same as schema in ClickHouse
+SCHEMA_MISMATCH_ERROR_CODES = (
+    errors.ErrorCodes.THERE_IS_NO_COLUMN,
+    errors.ErrorCodes.NOT_FOUND_COLUMN_IN_BLOCK,
+    errors.ErrorCodes.NO_SUCH_COLUMN_IN_TABLE,
+    errors.ErrorCodes.TYPE_MISMATCH,
+)
 
 
 class ClickHouse(Warehouse):
-    clickhouse_client: Client
     clickhouse_cluster: str
     created_tables: Set[str]
+    schema_cache: SchemaCache
+    columnar_insert: bool
+    pool: ConnectionPool
+    schema_lock: threading.RLock
 
     def connect(self):
-        self.clickhouse_client = Client(
-            host=self.conf_dict["host"],
-            port=self.conf_dict.get("port", 9000),
-            user=self.conf_dict["user"],
-            password=self.conf_dict["password"],
-        )
+        # Every query, DDL included, runs on an insert thread of warehouse and holds a connection only while it runs,
+        # so one connection per insert thread is enough
+        pool_size = self.conf_dict.get("pool_size", self.conf_dict.get("max_concurrent_inserts", 1))
+        self.pool = ConnectionPool(self.new_client, pool_size)
+        # Held while changing or describing a table and caching the result, so that a refresh in one thread
+        # can not overwrite columns added to cache by another thread
+        self.schema_lock = threading.RLock()
         self.clickhouse_cluster = self.conf_dict.get("cluster")
+        self.columnar_insert = self.conf_dict.get("columnar_insert", True)
         logger.info("connecting to ClickHouse")
         logger.info(f"Running sample query {SAMPLE_QUERY}")
 
-        result = self.clickhouse_client.execute(SAMPLE_QUERY)
+        result = self.execute(SAMPLE_QUERY)
         logger.info(f"Result = {result}")
 
         self.created_tables = set()
+        self.schema_cache = SchemaCache()
         return True
 
+    def new_client(self):
+        settings = {}
+        for setting in CLIENT_SETTINGS:
+            if setting in self.conf_dict:
+                settings[setting] = self.conf_dict[setting]
+        return Client(
+            host=self.conf_dict["host"],
+            port=self.conf_dict.get("port", 9000),
+            user=self.conf_dict["user"],
+            password=self.conf_dict["password"],
+            compression=self.conf_dict.get("compression", False),
+            connect_timeout=self.conf_dict.get("connect_timeout", 10),
+            send_receive_timeout=self.conf_dict.get("send_receive_timeout", 300),
+            sync_request_timeout=self.conf_dict.get("sync_request_timeout", 5),
+            settings=settings,
+        )
+
+    def execute(self, query: str, *args, **kwargs):
+        """Runs query on a pooled connection. Round trips are timed per kind of query, e.g. ALTER or INSERT."""
+        with metrics.timer("query_seconds", warehouse=self.name, query=query.split(None, 1)[0].upper()):
+            with self.pool.connection() as client:
+                return client.execute(query, *args, **kwargs)
+
     # @abstractmethod
     def create_schema(self, schema: str):
         """ Create schema or namespace if does not exist"""
+        if schema in self.schema_cache.schemas:
+            return
+
         create_db_sql = f"CREATE DATABASE IF NOT EXISTS {schema}"
         if self.clickhouse_cluster:
             create_db_sql = f"{create_db_sql} ON CLUSTER {self.clickhouse_cluster}"
 
-        result = self.clickhouse_client.execute(create_db_sql)
+        result = self.execute(create_db_sql)
         logger.debug(f"Creating Database {schema}, result = {result}")
+        self.schema_cache.schemas.add(schema)
 
     # @abstractmethod
-    def create_table(self, schema: str, table: str, col_types: dict, non_null_columns: List[str]):
+    def create_table(self, schema: str, table: str, col_types: dict, non_null_columns: List[str],
+                     low_cardinality_columns: Collection[str] = ()):
         """ Create table if does not exist"""
         if f"{schema}.{table}" in self.created_tables:
             return
@@ -76,7 +128,9 @@ class ClickHouse(Warehouse):
         else:
             column_type_defs = []
             for col_name, col_type in col_types.items():
-                column_type_defs.append(self.to_ch_column_def(col_name, col_type, non_null_columns))
+                column_type_defs.append(
+                    self.to_ch_column_def(col_name, col_type, non_null_columns, low_cardinality_columns)
+                )
 
             sql = f"""
             CREATE TABLE IF NOT EXISTS {schema}.{table}
@@ -87,12 +141,14 @@ class ClickHouse(Warehouse):
             ORDER BY (timestamp, message_id)
             """
         logger.debug(f"Running SQL = {sql}")
-        result = self.clickhouse_client.execute(sql)
+        result = self.execute(sql)
         logger.debug(f"Creating Table {schema}.{table}, result = {result}")
 
         self.created_tables.add(f"{schema}.{table}")
+        self.cache_created_table(schema, table, col_types)
 
-    def create_users_table(self, schema: str, col_types: dict, non_null_columns: List[str]):
+    def create_users_table(self, schema: str, col_types: dict, non_null_columns: List[str],
+                           low_cardinality_columns: Collection[str] = ()):
         """ Create table if does not exist"""
         table = "users"
         if f"{schema}.{table}" in self.created_tables:
@@ -105,7 +161,7 @@ class ClickHouse(Warehouse):
             for col_name, col_type in col_types.items():
                 column_type_defs.append(
                     self.to_ch_column_def(
-                        col_name, col_type, non_null_columns
+                        col_name, col_type, non_null_columns, low_cardinality_columns
                     )
                 )
 
@@ -117,35 +173,74 @@ class ClickHouse(Warehouse):
             ORDER BY (user_id)
             """
         logger.debug(f"Running SQL = {sql}")
-        result = self.clickhouse_client.execute(sql)
+        result = self.execute(sql)
         logger.debug(f"Creating Table {schema}.{table}, result = {result}")
 
         self.created_tables.add(f"{schema}.{table}")
+        self.cache_created_table(schema, table, col_types)
+
+    def cache_created_table(self, schema: str, table: str, col_types: dict):
+        """
+        Caches columns of created table, so that it is not described right after. A table which existed before
+        may differ from them, an insert failing because of that refreshes cached schema and is retried.
+        """
+        with self.schema_lock:
+            if self.schema_cache.get(schema, table) is None:
+                # Cache the types as DESCRIBE would return them, e.g. BOOLEAN is stored as UInt8
+                self.schema_cache.put(
+                    schema, table, {c: self.ch_type_to_seghouse_type(DT_TO_CH_DT[t]) for c, t in col_types.items()}
+                )
 
     @staticmethod
     def to_ch_column_def(
-            column_name, column_type, non_null_columns=["received_at", "timestamp", "message_id"]
+            column_name, column_type, non_null_columns=["received_at", "timestamp", "message_id"],
+            low_cardinality_columns=()
     ):
+        ch_type = ClickHouse.to_ch_type(column_name, column_type, non_null_columns, low_cardinality_columns)
+        return f"{column_name} {ch_type}"
+
+    @staticmethod
+    def to_ch_type(column_name, column_type, non_null_columns, low_cardinality_columns=()):
         ch_type = DT_TO_CH_DT.get(column_type)
         if ch_type is None:
             raise Exception(f"Unable to find ch_type for DT = {column_type}")
-        if column_name not in non_null_columns:
+        if column_name not in non_null_columns and column_type not in NON_NULLABLE_DATATYPES:
             ch_type = f"Nullable({ch_type})"
-        return f"{column_name} {ch_type}"
+        if column_type == DataType.STRING and column_name in low_cardinality_columns:
+            ch_type = f"LowCardinality({ch_type})"
+        return ch_type
 
     # @abstractmethod
     def describe_table(self, schema: str, table: str):
+        """ Returns column types of table from schema cache. ClickHouse is queried only if table is not cached"""
+        table_schema = self.schema_cache.get(schema, table)
+        if table_schema is None:
+            table_schema = self.refresh_table(schema, table)
+        return dict(table_schema.columns)
+
+    def refresh_table(self, schema: str, table: str):
         sql = f"DESCRIBE TABLE {schema}.{table}"
         logger.debug(f"Running SQL = {sql}")
-        result = self.clickhouse_client.execute(sql)
-        col_types = {}
-        for x in result:
-            col_types[x[0]] = self.ch_type_to_seghouse_type(x[1])
-        return col_types
+        with self.schema_lock:
+            result = self.execute(sql)
+            col_types = {}
+            for x in result:
+                col_types[x[0]] = self.ch_type_to_seghouse_type(x[1])
+            return self.schema_cache.put(schema, table, col_types)
 
     @staticmethod
     def ch_type_to_seghouse_type(ch_type):
-        if "UInt8" in ch_type:
+        # Checked first, as key, value and element types look like other types
+        if ch_type.startswith("Map("):
+            return DataType.MAP
+        elif ch_type.startswith("Array("):
+            element_type = ClickHouse.ch_type_to_seghouse_type(ch_type[len("Array("):-1])
+            if element_type in INT_DATATYPES:
+                return DataType.ARRAY_INT64
+            elif element_type in FLOAT_DATATYPES:
+                return DataType.ARRAY_FLOAT64
+            return DataType.ARRAY
+        elif "UInt8" in ch_type:
             return DataType.UINT8
         elif "UInt16" in ch_type:
             return DataType.UINT16
@@ -182,38 +277,74 @@ class ClickHouse(Warehouse):
         else:
             raise Exception(f"unable to convert ch_type {ch_type}")
 
-    def add_column(self, schema: str, table: str, column: str, column_type: DataType, non_null_columns: List[str]):
-        sql = f"ALTER TABLE {schema}.{table} ADD COLUMN IF NOT EXISTS {self.to_ch_column_def(column, column_type, non_null_columns)}"
-        logger.debug(f"Running SQL = {sql}")
-        result = self.clickhouse_client.execute(sql)
-        logger.debug(
-            f"Adding column to {schema}.{table}, {column}, {column_type} result = {result}"
-        )
+    def add_column(self, schema: str, table: str, column: str, column_type: DataType, non_null_columns: List[str],
+                   low_cardinality_columns: Collection[str] = ()):
+        self.add_columns(schema, table, {column: column_type}, non_null_columns, low_cardinality_columns)
 
-    def insert_df(self, schema: str, table: str, dataframe):
-        df = dataframe.copy()
-        col_types = dataframe_util.get_datatypes(df)
-        dataframe_util.cast_boolean_to_int(df, col_types)
-        # dataframe_util.mark_int_na_to_default(df, col_types)
-        # dataframe_util.mark_float_na_to_default(df, col_types)
+    def add_columns(self, schema: str, table: str, columns: Dict[str, DataType], non_null_columns: List[str],
+                    low_cardinality_columns: Collection[str] = ()):
+        """ Adds all columns using one ALTER TABLE with an ADD COLUMN clause per column"""
+        if not columns:
+            return
 
+        add_clauses = [
+            f"ADD COLUMN IF NOT EXISTS "
+            f"{self.to_ch_column_def(column, column_type, non_null_columns, low_cardinality_columns)}"
+            for column, column_type in columns.items()
+        ]
+        sql = f"ALTER TABLE {schema}.{table} {', '.join(add_clauses)}"
+        logger.debug(f"Running SQL = {sql}")
+        with self.schema_lock:
+            result = self.execute(sql)
+            logger.debug(
+                f"Adding columns to {schema}.{table}, {columns} result = {result}"
+            )
+            # Cache the types as DESCRIBE would return them, e.g. BOOLEAN is stored as UInt8
+            self.schema_cache.add_columns(
+                schema, table,
+                {c: self.ch_type_to_seghouse_type(DT_TO_CH_DT[t]) for c, t in columns.items()}
+            )
+
+    def insert_df(self, schema: str, table: str, dataframe, col_types: Dict[str, DataType] = None):
+        try:
+            self._insert_df(schema, table, dataframe, col_types)
+        except errors.Error as e:
+            if e.code not in SCHEMA_MISMATCH_ERROR_CODES:
+                raise
+            logger.warning(f"Cached schema of {schema}.{table} looks stale, refreshing it and retrying insert. "
+                           f"error = {e}")
+            metrics.inc("schema_refreshes", warehouse=self.name, table=table)
+            self.refresh_table(schema, table)
+            self._insert_df(schema, table, dataframe, col_types)
+
+    def _insert_df(self, schema: str, table: str, dataframe, col_types: Dict[str, DataType] = None):
         table_column_types = self.describe_table(schema, table)
-        dataframe_util.add_missing_columns(df, table_column_types)
         logger.debug(f"{table} table_column_types = {table_column_types}")
+        df, misfits = dataframe_util.cast_to_table(dataframe, table_column_types, col_types)
+
+        columns = list(table_column_types.keys())
+        insert_sql = f"INSERT INTO {schema}.{table} ({', '.join(columns)}) VALUES"
+        if self.columnar_insert:
+            result = self.execute(
+                insert_sql,
+                [df[c].tolist() for c in columns],
+                types_check=True,
+                columnar=True,
+            )
+        else:
+            result = self.execute(
+                insert_sql,
+                df[columns].to_dict("records"),
+                types_check=True,
+            )
+        logger.info(f"Inserting DataFrame in {schema}.{table}, result = {result}")
 
-        df_dicts = df.to_dict("records")
-        misfits = dataframe_util.fix_data_types(df, df_dicts, table_column_types)
+        # Misfits are inserted after rows so that a retried insert does not send them twice
+        metrics.inc("misfits", len(misfits), warehouse=self.name, table=table)
         for m in misfits:
             m['table_name'] = table
         self.insert_misfits(schema, misfits)
 
-        result = self.clickhouse_client.execute(
-            f"INSERT INTO {schema}.{table} VALUES",
-            df_dicts,
-            types_check=True,
-        )
-        logger.info(f"Inserting DataFrame in {schema}.{table}, result = {result}")
-
     def create_misfits_table(self, schema: str):
         table = default_table_structure.MISFITS_TABLE
         if f"{schema}.{table}" in self.created_tables:
@@ -232,7 +363,7 @@ class ClickHouse(Warehouse):
                             ORDER BY (message_id, table_name, column_name)
                             """
         logger.debug(f"Running SQL = {sql}")
-        result = self.clickhouse_client.execute(sql)
+        result = self.execute(sql)
         logger.debug(f"Creating Table {schema}.{table}, result = {result}")
 
         self.created_tables.add(f"{schema}.{table}")
@@ -244,7 +375,7 @@ class ClickHouse(Warehouse):
         self.create_misfits_table(schema)
 
         table = default_table_structure.MISFITS_TABLE
-        result = self.clickhouse_client.execute(
+        result = self.execute(
             f"INSERT INTO {schema}.{table} VALUES",
             misfits,
             types_check=True,
@@ -252,4 +383,5 @@ class ClickHouse(Warehouse):
         logger.info(f"Inserting DataFrame in {schema}.{table}, result = {result}")
 
     def close(self):
-        return
+        logger.info(f"Connection pool of {self.conf_dict['host']} : {self.pool.stats.summary()}")
+        self.pool.close()
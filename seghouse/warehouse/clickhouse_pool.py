@@ -0,0 +1,72 @@
+import contextlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Callable, List
+
+from clickhouse_driver import Client
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass()
+class PoolStats:
+    """Usage of connections of a pool"""
+
+    created: int = 0
+    acquired: int = 0
+    waited: int = 0
+
+    def reused(self):
+        return self.acquired - self.created
+
+    def summary(self):
+        return f"connections created = {self.created}, acquired = {self.acquired}, reused = {self.reused()}, " \
+               f"waited for a free connection = {self.waited}"
+
+
+class ConnectionPool:
+    """
+    Pool of at most max_size ClickHouse clients. A client is used by one thread at a time and is returned to pool
+    after use, so connections are reused across queries and threads. Threads wait when all clients are in use.
+    """
+
+    def __init__(self, new_client: Callable[[], Client], max_size: int):
+        self.new_client = new_client
+        self.max_size = max_size
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self.idle: List[Client] = []
+        self.clients: List[Client] = []
+        self.stats = PoolStats()
+
+    @contextlib.contextmanager
+    def connection(self):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats.waited += 1
+            self.slots.acquire()
+        try:
+            with self.lock:
+                self.stats.acquired += 1
+                client = self.idle.pop() if self.idle else None
+            if client is None:
+                client = self.new_client()
+                with self.lock:
+                    self.stats.created += 1
+                    self.clients.append(client)
+            try:
+                yield client
+            finally:
+                # Client reconnects by itself on next query if connection got broken
+                with self.lock:
+                    self.idle.append(client)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for client in self.clients:
+                client.disconnect()
+            self.clients = []
+            self.idle = []
@@ -1,11 +1,14 @@
 from .clickhouse import ClickHouse
+from .file_warehouse import FileWarehouse
 
 
-def get_warehouse(warehouse_conf: dict):
+def get_warehouse(warehouse_conf: dict, name: str = None):
     if "clickhouse" == warehouse_conf["type"]:
-        return ClickHouse(warehouse_conf)
+        return ClickHouse(warehouse_conf, name)
+    elif "file" == warehouse_conf["type"]:
+        return FileWarehouse(warehouse_conf, name)
     else:
-        raise WarehouseError(f"Unable to get warehouse of type {type}")
+        raise WarehouseError(f"Unable to get warehouse of type {warehouse_conf['type']}")
 
 
 class WarehouseError(Exception):
@@ -0,0 +1,265 @@
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Collection, Dict, List
+
+import pandas as pd
+from clickhouse_driver.block import ColumnOrientedBlock
+from clickhouse_driver.bufferedwriter import BufferedSocketWriter
+from clickhouse_driver.connection import ServerInfo
+from clickhouse_driver.context import Context
+from clickhouse_driver.streams.native import BlockOutputStream
+
+from .clickhouse import ClickHouse
+from .warehouse import Warehouse
+from ..config import default_table_structure
+from ..config.data_type import DataType
+from ..util import dataframe_util, metrics
+
+logger = logging.getLogger(__name__)
+
+FILE_FORMATS = ["native", "parquet"]
+SCHEMA_FILE = "schema.json"
+MISFITS_STRUCTURE = {
+    "message_id": DataType.STRING,
+    "table_name": DataType.STRING,
+    "column_name": DataType.STRING,
+    "column_value": DataType.STRING,
+    "expected_data_type": DataType.STRING,
+    "actual_data_type": DataType.STRING,
+}
+NATIVE_BUFFER_SIZE = 1024 * 1024
+# Client settings used by clickhouse_driver columns to serialize values
+NATIVE_CLIENT_SETTINGS = {
+    "strings_as_bytes": False,
+    "strings_encoding": "utf-8",
+    "use_numpy": False,
+    "input_format_null_as_default": False,
+    "namedtuple_as_json": True,
+}
+
+
+class FileSocket:
+    """Lets clickhouse_driver write blocks, which it sends over sockets, to a file"""
+
+    def __init__(self, file):
+        self.file = file
+
+    def sendall(self, data):
+        self.file.write(data)
+
+
+class FileWarehouse(Warehouse):
+    """
+    Writes every insert of a table to a file of its own in directory/schema/table, in ClickHouse Native
+    or Parquet format, so that transformed events can be bulk loaded with clickhouse-client or clickhouse-local.
+    Columns of table with their ClickHouse types are kept in schema.json next to its files.
+    Schema files are rewritten atomically and read on every use, so that worker processes see changes of others.
+    """
+
+    directory: str
+    file_format: str
+    lock: threading.RLock
+    native_context: Context
+    files_written: int
+
+    def connect(self):
+        self.directory = os.path.expanduser(self.conf_dict["directory"])
+        self.file_format = self.conf_dict.get("format", "native")
+        if self.file_format not in FILE_FORMATS:
+            raise Exception(f"Unknown file format {self.file_format}, expected one of {FILE_FORMATS}")
+        if self.file_format == "parquet":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError as e:
+                raise Exception(f"Parquet format needs pyarrow, install it with pip install pyarrow: {e!r}") from e
+        os.makedirs(self.directory, exist_ok=True)
+        logger.info(f"Writing {self.file_format} files to {self.directory}")
+        self.lock = threading.RLock()
+        self.native_context = Context()
+        # Naive datetimes are written as UTC, like a ClickHouse server in UTC would store them
+        self.native_context.server_info = self.native_server_info()
+        self.native_context.settings = {}
+        self.native_context.client_settings = NATIVE_CLIENT_SETTINGS
+        self.files_written = 0
+        return True
+
+    @staticmethod
+    def native_server_info():
+        """
+        ServerInfo of a ClickHouse server in UTC. Arguments differ between driver versions,
+        e.g. used_revision was added after 0.2.1, so only the ones of installed driver are passed.
+        """
+        info = {
+            "name": "seghouse", "version_major": 0, "version_minor": 0, "version_patch": 0, "revision": 0,
+            "timezone": "UTC", "display_name": "seghouse", "used_revision": 0,
+        }
+        parameters = inspect.signature(ServerInfo).parameters
+        return ServerInfo(**{k: v for k, v in info.items() if k in parameters})
+
+    def table_dir(self, schema: str, table: str):
+        return os.path.join(self.directory, schema, table)
+
+    def read_columns(self, schema: str, table: str):
+        """Returns column -> ClickHouse type of table, None if table does not exist"""
+        schema_file = os.path.join(self.table_dir(schema, table), SCHEMA_FILE)
+        if not os.path.exists(schema_file):
+            return None
+        with open(schema_file) as f:
+            return dict(json.load(f)["columns"])
+
+    def write_columns(self, schema: str, table: str, columns: Dict[str, str]):
+        table_dir = self.table_dir(schema, table)
+        os.makedirs(table_dir, exist_ok=True)
+        content = {
+            "database": schema,
+            "table": table,
+            "format": self.file_format,
+            "columns": columns,
+            # For clickhouse-local --structure and CREATE TABLE
+            "structure": ", ".join(f"{c} {t}" for c, t in columns.items()),
+        }
+        tmp_file = os.path.join(table_dir, f".{SCHEMA_FILE}.{uuid.uuid4().hex}")
+        with open(tmp_file, "w") as f:
+            json.dump(content, f, indent=2)
+        os.replace(tmp_file, os.path.join(table_dir, SCHEMA_FILE))
+
+    def create_schema(self, schema: str):
+        os.makedirs(os.path.join(self.directory, schema), exist_ok=True)
+
+    def create_table(self, schema: str, table: str, col_types: dict, non_null_columns: List[str],
+                     low_cardinality_columns: Collection[str] = ()):
+        with self.lock:
+            if self.read_columns(schema, table) is not None:
+                return
+            logger.info(f"Creating schema file of {schema}.{table}")
+            self.write_columns(schema, table, {
+                c: ClickHouse.to_ch_type(c, t, non_null_columns, low_cardinality_columns) for c, t in col_types.items()
+            })
+
+    def create_users_table(self, schema: str, col_types: dict, non_null_columns: List[str],
+                           low_cardinality_columns: Collection[str] = ()):
+        self.create_table(
+            schema, default_table_structure.USERS_TABLE, col_types, non_null_columns, low_cardinality_columns
+        )
+
+    def create_misfits_table(self, schema: str):
+        self.create_table(schema, default_table_structure.MISFITS_TABLE, MISFITS_STRUCTURE, list(MISFITS_STRUCTURE))
+
+    def describe_table(self, schema: str, table: str):
+        columns = self.read_columns(schema, table)
+        if columns is None:
+            raise Exception(f"Table {schema}.{table} does not exist in {self.directory}")
+        return {c: ClickHouse.ch_type_to_seghouse_type(t) for c, t in columns.items()}
+
+    def add_column(self, schema: str, table: str, column: str, column_type: DataType, non_null_columns: List[str],
+                   low_cardinality_columns: Collection[str] = ()):
+        self.add_columns(schema, table, {column: column_type}, non_null_columns, low_cardinality_columns)
+
+    def add_columns(self, schema: str, table: str, columns: Dict[str, DataType], non_null_columns: List[str],
+                    low_cardinality_columns: Collection[str] = ()):
+        if not columns:
+            return
+        with self.lock:
+            table_columns = self.read_columns(schema, table)
+            for column, column_type in columns.items():
+                table_columns.setdefault(
+                    column, ClickHouse.to_ch_type(column, column_type, non_null_columns, low_cardinality_columns)
+                )
+            logger.info(f"Adding columns {list(columns)} to schema file of {schema}.{table}")
+            self.write_columns(schema, table, table_columns)
+
+    def insert_df(self, schema: str, table: str, dataframe, col_types: Dict[str, DataType] = None):
+        columns = self.read_columns(schema, table)
+        if columns is None:
+            raise Exception(f"Table {schema}.{table} does not exist in {self.directory}")
+        df, misfits = dataframe_util.cast_to_table(
+            dataframe, {c: ClickHouse.ch_type_to_seghouse_type(t) for c, t in columns.items()}, col_types
+        )
+
+        file_name = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex}.{self.file_format}"
+        file_path = os.path.join(self.table_dir(schema, table), file_name)
+        # Written under a hidden name and renamed, so that loaders never pick up a partial file
+        tmp_path = os.path.join(self.table_dir(schema, table), f".{file_name}")
+        if self.file_format == "parquet":
+            self.write_parquet(tmp_path, columns, df)
+        else:
+            self.write_native(tmp_path, columns, df)
+        os.replace(tmp_path, file_path)
+        with self.lock:
+            self.files_written += 1
+        logger.info(f"Wrote {dataframe_util.row_count(df)} rows of {schema}.{table} to {file_path}")
+
+        metrics.inc("misfits", len(misfits), warehouse=self.name, table=table)
+        for m in misfits:
+            m['table_name'] = table
+        self.insert_misfits(schema, misfits)
+
+    def write_native(self, file_path: str, columns: Dict[str, str], df):
+        block = ColumnOrientedBlock(
+            columns_with_types=list(columns.items()), data=[df[c].tolist() for c in columns], types_check=True
+        )
+        with open(file_path, "wb") as f:
+            # Same block format as ClickHouse Native, as blocks of revision 0 carry no block info
+            writer = BufferedSocketWriter(FileSocket(f), NATIVE_BUFFER_SIZE)
+            BlockOutputStream(writer, self.native_context).write(block)
+
+    @staticmethod
+    def write_parquet(file_path: str, columns: Dict[str, str], df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        fields = [pa.field(c, parquet_type(t), nullable=nullable(t)) for c, t in columns.items()]
+        arrays = [pa.array(df[field.name].tolist(), type=field.type) for field in fields]
+        pq.write_table(pa.Table.from_arrays(arrays, schema=pa.schema(fields)), file_path)
+
+    def insert_misfits(self, schema: str, misfits: List[dict]):
+        if not misfits:
+            return
+        self.create_misfits_table(schema)
+        self.insert_df(schema, default_table_structure.MISFITS_TABLE, pd.DataFrame(misfits))
+
+    def close(self):
+        logger.info(f"Wrote {self.files_written} files to {self.directory}")
+
+
+def nullable(ch_type: str):
+    if ch_type.startswith("LowCardinality("):
+        ch_type = ch_type[len("LowCardinality("):-1]
+    return ch_type.startswith("Nullable(")
+
+
+def parquet_type(ch_type: str):
+    """Arrow type of ClickHouse type. Parquet encodes columns with few values with a dictionary by itself."""
+    import pyarrow as pa
+
+    if ch_type.startswith("LowCardinality("):
+        ch_type = ch_type[len("LowCardinality("):-1]
+    if ch_type.startswith("Nullable("):
+        ch_type = ch_type[len("Nullable("):-1]
+    if ch_type == "Map(String, String)":
+        return pa.map_(pa.string(), pa.string())
+    if ch_type.startswith("Array("):
+        return pa.list_(parquet_type(ch_type[len("Array("):-1]))
+    types = {
+        "UInt8": pa.uint8(),
+        "UInt16": pa.uint16(),
+        "UInt32": pa.uint32(),
+        "UInt64": pa.uint64(),
+        "Int8": pa.int8(),
+        "Int16": pa.int16(),
+        "Int32": pa.int32(),
+        "Int64": pa.int64(),
+        "Float32": pa.float32(),
+        "Float64": pa.float64(),
+        "String": pa.string(),
+        "Date": pa.date32(),
+        "DateTime": pa.timestamp("ms", tz="UTC"),
+    }
+    if ch_type not in types:
+        raise Exception(f"Unable to write ClickHouse type {ch_type} to parquet")
+    return types[ch_type]
@@ -0,0 +1,48 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set
+
+from ..config.data_type import DataType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TableSchema:
+    """Column types of a table as last seen by this process"""
+
+    columns: Dict[str, DataType]
+    version: int = 1
+
+
+@dataclass
+class SchemaCache:
+    """
+    Versioned in-process cache of warehouse schemas keyed by schema.table.
+    Version of a table is bumped every time its columns change.
+    """
+
+    schemas: Set[str] = field(default_factory=set)
+    tables: Dict[str, TableSchema] = field(default_factory=dict)
+
+    def get(self, schema: str, table: str) -> Optional[TableSchema]:
+        return self.tables.get(f"{schema}.{table}")
+
+    def put(self, schema: str, table: str, columns: Dict[str, DataType]) -> TableSchema:
+        key = f"{schema}.{table}"
+        previous = self.tables.get(key)
+        table_schema = TableSchema(dict(columns), previous.version + 1 if previous else 1)
+        self.tables[key] = table_schema
+        logger.debug(f"Cached schema of {key}, version = {table_schema.version}")
+        return table_schema
+
+    def add_columns(self, schema: str, table: str, columns: Dict[str, DataType]):
+        """Adds columns to cached table. Tables not yet cached are left alone and described on next use."""
+        table_schema = self.get(schema, table)
+        if table_schema is None:
+            return
+        new_columns = {c: t for c, t in columns.items() if c not in table_schema.columns}
+        if new_columns:
+            table_schema.columns.update(new_columns)
+            table_schema.version += 1
+            logger.debug(f"Added {list(new_columns)} to cached schema of {schema}.{table}, version = {table_schema.version}")
@@ -0,0 +1,60 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict
+
+import pandas as pd
+
+from ..config.configuration import LowCardinality
+from ..config.data_type import DataType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SchemaDiff:
+    """Columns which have to be added to a warehouse table before a batch can be inserted"""
+
+    schema: str
+    table: str
+    new_columns: Dict[str, DataType] = field(default_factory=dict)
+
+    def empty(self):
+        return not self.new_columns
+
+    def summary(self):
+        columns = ", ".join(f"{c} {t.value}" for c, t in self.new_columns.items())
+        return f"{self.schema}.{self.table} : add {len(self.new_columns)} columns ({columns})"
+
+
+def plan(schema: str, table: str, col_types: Dict[str, DataType], table_col_types: Dict[str, DataType]):
+    """Collects every column of batch which does not exist in table"""
+    new_columns = {c: t for c, t in col_types.items() if c not in table_col_types}
+    return SchemaDiff(schema, table, new_columns)
+
+
+class LowCardinalityColumns:
+    """
+    String columns of a batch to be created as LowCardinality, see configuration.LowCardinality.
+    Distinct values of a column are counted only when it is asked for, which is when the column is being created,
+    and counts are kept while a warehouse creates and alters the table for same batch.
+    """
+
+    def __init__(self, conf: LowCardinality, df: pd.DataFrame):
+        self.conf = conf
+        self.df = df
+        self.decided: Dict[str, bool] = {}
+
+    def __contains__(self, column):
+        if column in self.conf.columns:
+            return True
+        if column in self.conf.excluded_columns or not self.conf.max_ratio or column not in self.df.columns:
+            return False
+        if column not in self.decided:
+            values = self.df[column].to_numpy()
+            values = values[~pd.isna(values)]
+            distinct = len(pd.unique(values))
+            self.decided[column] = len(values) >= self.conf.min_values and distinct <= self.conf.max_distinct \
+                and distinct <= self.conf.max_ratio * len(values)
+            logger.info(f"Column {column} has {distinct} distinct of {len(values)} values, "
+                        f"low cardinality = {self.decided[column]}")
+        return self.decided[column]
@@ -1,5 +1,5 @@
 from abc import ABCMeta, abstractmethod
-from typing import List
+from typing import Collection, Dict, List
 
 from ..config.data_type import DataType
 
@@ -8,10 +8,13 @@ class Warehouse(metaclass=ABCMeta):
     """Abstract Warehouse class"""
 
     conf_dict: dict
+    # Name of warehouse in logs and metrics
+    name: str
 
-    def __init__(self, conf_dict):
+    def __init__(self, conf_dict, name: str = None):
         """Should Create connection"""
         self.conf_dict = conf_dict
+        self.name = name or conf_dict.get("name", conf_dict["type"])
         self.connect()
 
     @abstractmethod
@@ -24,12 +27,14 @@ class Warehouse(metaclass=ABCMeta):
         return
 
     @abstractmethod
-    def create_table(self, schema: str, table: str, col_types: dict, non_null_columns: List[str]):
-        """ Create table if does not exist"""
+    def create_table(self, schema: str, table: str, col_types: dict, non_null_columns: List[str],
+                     low_cardinality_columns: Collection[str] = ()):
+        """ Create table if does not exist. String columns in low_cardinality_columns are stored with a dictionary"""
         return
 
     @abstractmethod
-    def create_users_table(self, schema: str, col_types: dict, non_null_columns: List[str]):
+    def create_users_table(self, schema: str, col_types: dict, non_null_columns: List[str],
+                           low_cardinality_columns: Collection[str] = ()):
         """ Create users table if does not exist"""
         return
 
@@ -48,11 +53,19 @@ class Warehouse(metaclass=ABCMeta):
         return
 
     @abstractmethod
-    def add_column(self, schema: str, table: str, column: str, column_type: DataType, non_null_columns: List[str]):
+    def add_column(self, schema: str, table: str, column: str, column_type: DataType, non_null_columns: List[str],
+                   low_cardinality_columns: Collection[str] = ()):
         return
 
     @abstractmethod
-    def insert_df(self, schema: str, table: str, df):
+    def add_columns(self, schema: str, table: str, columns: Dict[str, DataType], non_null_columns: List[str],
+                    low_cardinality_columns: Collection[str] = ()):
+        """ Add all columns to table in a single schema change"""
+        return
+
+    @abstractmethod
+    def insert_df(self, schema: str, table: str, df, col_types: Dict[str, DataType] = None):
+        """ Insert df into table. col_types are types of df columns, inferred from df if not given"""
         return
 
     @abstractmethod
@@ -0,0 +1,88 @@
+import pandas as pd
+import pytest
+from clickhouse_driver import errors
+
+from seghouse.config.data_type import DataType
+from seghouse.warehouse.clickhouse import ClickHouse
+from seghouse.warehouse.schema_cache import SchemaCache
+
+
+class ScriptedClickHouse(ClickHouse):
+    """ClickHouse which records queries instead of sending them, answering DESCRIBE with columns and failing
+    the first inserts with insert_errors"""
+
+    def __init__(self, columns=None, insert_errors=()):
+        self.queries = []
+        self.columns = columns or {}
+        self.insert_errors = list(insert_errors)
+        self.inserts = []
+        super().__init__({"type": "clickhouse", "host": "localhost", "user": "u", "password": "p"})
+
+    def execute(self, query: str, *args, **kwargs):
+        self.queries.append(query.split(None, 1)[0].upper())
+        if query.startswith("DESCRIBE"):
+            return list(self.columns.items())
+        if query.startswith("INSERT"):
+            if self.insert_errors:
+                raise self.insert_errors.pop(0)
+            self.inserts.append((query, args[0]))
+        return []
+
+
+def test_schema_cache_versions_tables():
+    cache = SchemaCache()
+    assert cache.get("app", "tracks") is None
+
+    cache.put("app", "tracks", {"a": DataType.STRING})
+    cache.add_columns("app", "tracks", {"a": DataType.STRING})
+    assert cache.get("app", "tracks").version == 1
+
+    cache.add_columns("app", "tracks", {"b": DataType.INT64})
+    assert cache.get("app", "tracks").columns == {"a": DataType.STRING, "b": DataType.INT64}
+    assert cache.get("app", "tracks").version == 2
+
+    cache.put("app", "tracks", {"c": DataType.FLOAT64})
+    assert cache.get("app", "tracks").columns == {"c": DataType.FLOAT64}
+    assert cache.get("app", "tracks").version == 3
+
+    cache.add_columns("app", "pages", {"a": DataType.STRING})
+    assert cache.get("app", "pages") is None
+
+
+def test_created_table_is_cached_as_described():
+    warehouse = ScriptedClickHouse()
+    warehouse.create_table("app", "tracks", {"message_id": DataType.STRING, "flag": DataType.BOOLEAN}, ["message_id"])
+
+    assert warehouse.describe_table("app", "tracks") == {"message_id": DataType.STRING, "flag": DataType.UINT8}
+    assert "DESCRIBE" not in warehouse.queries
+
+
+def test_table_is_described_once():
+    warehouse = ScriptedClickHouse({"message_id": "String", "count": "Nullable(Int64)"})
+    for _ in range(2):
+        assert warehouse.describe_table("app", "tracks") == {"message_id": DataType.STRING, "count": DataType.INT64}
+    assert warehouse.queries.count("DESCRIBE") == 1
+
+
+def test_insert_refreshes_stale_schema_and_is_retried():
+    mismatch = errors.ServerException(
+        "No such column count in table app.tracks", code=errors.ErrorCodes.NO_SUCH_COLUMN_IN_TABLE
+    )
+    warehouse = ScriptedClickHouse({"message_id": "String"}, [mismatch])
+    warehouse.schema_cache.put("app", "tracks", {"message_id": DataType.STRING, "count": DataType.INT64})
+
+    warehouse.insert_df("app", "tracks", pd.DataFrame({"message_id": ["m1"], "count": [1]}))
+
+    (query, values), = warehouse.inserts
+    assert query == "INSERT INTO app.tracks (message_id) VALUES"
+    assert values == [["m1"]]
+    assert warehouse.schema_cache.get("app", "tracks").columns == {"message_id": DataType.STRING}
+
+
+def test_insert_errors_of_other_kinds_are_not_retried():
+    error = errors.ServerException("Too many parts", code=errors.ErrorCodes.TOO_MANY_PARTS)
+    warehouse = ScriptedClickHouse({"message_id": "String"}, [error])
+
+    with pytest.raises(errors.ServerException, match="Too many parts"):
+        warehouse.insert_df("app", "tracks", pd.DataFrame({"message_id": ["m1"]}))
+    assert warehouse.queries.count("DESCRIBE") == 1
@@ -0,0 +1,139 @@
+import math
+
+import pandas as pd
+import pytest
+
+from seghouse.config.data_type import DataType
+from seghouse.util import dataframe_util
+
+
+TABLE_COLUMN_TYPES = {
+    "count": DataType.INT64,
+    "price": DataType.FLOAT64,
+    "flag": DataType.INT64,
+    "name": DataType.STRING,
+    "tags": DataType.ARRAY,
+    "missing": DataType.STRING,
+}
+
+
+CAST_INPUTS = {
+    "mixed": [1, "2", 3.7, " 4 ", True, "x"],
+    "none": [None, "1", None, "y"],
+    "nan": [float("nan"), 1.5, None, "nan"],
+    "overflow": [2 ** 70, "123456789012345678901234", 1e30, -2 ** 63, "-9223372036854775809"],
+    "bool strings": ["true", "True", "1", "0", False, "false"],
+}
+
+
+def per_value_cast(values, python_type):
+    """
+    Casts values one by one, like casts did before they were vectorized, once NaN was set to None.
+    Returns cast values and values which could not be cast.
+    """
+    cast = []
+    misfits = []
+    for value in values:
+        if value is None or (type(value) is float and math.isnan(value)):
+            cast.append(None)
+            continue
+        try:
+            cast.append(python_type(value))
+        except ValueError:
+            misfits.append(value)
+            cast.append(None)
+    return cast, misfits
+
+
+@pytest.mark.parametrize("values", CAST_INPUTS.values(), ids=CAST_INPUTS.keys())
+@pytest.mark.parametrize(
+    "cast, python_type",
+    [(dataframe_util.cast_to_int, int), (dataframe_util.cast_to_float, float), (dataframe_util.cast_to_str, str)],
+    ids=["int", "float", "str"],
+)
+def test_cast_matches_per_value_cast(cast, python_type, values):
+    df = pd.DataFrame({"message_id": [f"m{i}" for i in range(len(values))], "c": pd.Series(values, dtype=object)})
+    misfits = cast(df, "c") or []
+
+    expected, expected_misfits = per_value_cast(values, python_type)
+    # repr tells apart 1 and 1.0, and nan equals itself
+    assert [repr(v) for v in df["c"].tolist()] == [repr(v) for v in expected]
+    assert [m["column_value"] for m in misfits] == expected_misfits
+
+
+def shared_frame():
+    return pd.DataFrame(
+        {
+            "message_id": ["m1", "m2", "m3"],
+            "count": ["1", "2", "x"],
+            "price": [1, 2, 3],
+            "flag": [True, False, True],
+            "name": [1, "b", "c"],
+            "tags": [["a"], None, ["b", "c"]],
+        }
+    )
+
+
+@pytest.fixture(params=["isetitem", "insert"])
+def pandas_version(request, monkeypatch):
+    """Runs test with isetitem of pandas >= 1.5 and with fallback used by older pandas."""
+    if request.param == "insert":
+        if hasattr(pd.DataFrame, "isetitem"):
+            monkeypatch.delattr(pd.DataFrame, "isetitem")
+    elif not hasattr(pd.DataFrame, "isetitem"):
+        pytest.skip("pandas has no isetitem")
+    return request.param
+
+
+def test_cast_to_table_leaves_shared_frame_alone(pandas_version):
+    shared = shared_frame()
+    df, misfits = dataframe_util.cast_to_table(shared, TABLE_COLUMN_TYPES)
+
+    pd.testing.assert_frame_equal(shared, shared_frame())
+    assert [(m["message_id"], m["column_name"], m["column_value"]) for m in misfits] == [("m3", "count", "x")]
+    assert df["count"].tolist() == [1, 2, None]
+    assert df["price"].tolist() == [1.0, 2.0, 3.0]
+    assert df["flag"].tolist() == [1, 0, 1]
+    assert df["name"].tolist() == ["1", "b", "c"]
+    assert df["tags"].tolist() == [["a"], [], ["b", "c"]]
+    assert df["missing"].tolist() == [None, None, None]
+
+
+def test_mark_nan_to_none_leaves_shared_frame_alone(pandas_version):
+    shared = pd.DataFrame({"a": ["x", float("nan")], "b": [1.0, 2.0]})
+    df = dataframe_util.mark_nan_to_none(shared.copy(deep=False))
+
+    assert shared["a"].isna().tolist() == [False, True]
+    assert shared["a"].tolist()[1] is not None
+    assert df["a"].tolist() == ["x", None]
+    assert list(df.columns) == ["a", "b"]
+
+
+def test_cast_to_str_writes_lists_and_maps_as_json():
+    df = pd.DataFrame({"message_id": ["m1", "m2", "m3", "m4"], "name": ["a", ["b", 1], {"c": True}, None]})
+    df, misfits = dataframe_util.cast_to_table(df, {"name": DataType.STRING}, {"name": DataType.ARRAY})
+
+    assert misfits == []
+    assert df["name"].tolist() == ["a", '["b", 1]', '{"c": true}', None]
+
+
+def test_values_of_map_column_which_are_not_maps_are_misfits():
+    df = pd.DataFrame({"message_id": ["m1", "m2", "m3"], "context": [{"os": "ios"}, "android", None]})
+    df, misfits = dataframe_util.cast_to_table(df, {"context": DataType.MAP})
+
+    assert [(m["message_id"], m["column_value"]) for m in misfits] == [("m2", "android")]
+    assert df["context"].tolist() == [{"os": "ios"}, {}, {}]
+
+
+def test_concat_keeps_nulls_of_columns_missing_in_some_batches():
+    first = dataframe_util.TypedFrame(
+        pd.DataFrame({"count": [1], "name": ["x"]}), {"count": DataType.INT64, "name": DataType.STRING}
+    )
+    second = dataframe_util.TypedFrame(
+        pd.DataFrame({"count": [2, 3], "price": [1.5, None]}), {"count": DataType.INT64, "price": DataType.FLOAT64}
+    )
+    frame = dataframe_util.TypedFrame.concat([first, second])
+
+    assert frame.col_types == {"count": DataType.INT64, "name": DataType.STRING, "price": DataType.FLOAT64}
+    assert frame.df["name"].tolist() == ["x", None, None]
+    assert frame.df["count"].tolist() == [1, 2, 3]
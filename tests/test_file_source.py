@@ -0,0 +1,104 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from seghouse.util import aws_wrapper
+from seghouse.util.file_source import LocalDirSource, Prefetcher, S3Source
+
+
+class RecordingSource(LocalDirSource):
+    """Local directory which records files fetched and not yet released, failing to fetch failing_name"""
+
+    def __init__(self, source_dir, failing_name=None):
+        super().__init__(source_dir)
+        self.failing_name = failing_name
+        self.lock = threading.Lock()
+        self.held = set()
+        self.max_held = 0
+
+    def fetch(self, source_file):
+        if source_file.name == self.failing_name:
+            raise IOError(f"Can not fetch {source_file.name}")
+        with self.lock:
+            self.held.add(source_file.name)
+            self.max_held = max(self.max_held, len(self.held))
+        return super().fetch(source_file)
+
+    def release(self, source_file, local_path):
+        with self.lock:
+            self.held.discard(source_file.name)
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    for i in range(6):
+        (tmp_path / f"f{i}.json.gz").write_bytes(b"x" * (i + 1))
+    return str(tmp_path)
+
+
+def test_files_are_fetched_in_listing_order(source_dir):
+    source = LocalDirSource(source_dir)
+    prefetcher = Prefetcher(source, source.list_files(), 3)
+    names = []
+    for source_file, local_path in prefetcher:
+        assert local_path == os.path.join(source_dir, source_file.name)
+        names.append(source_file.name)
+        prefetcher.release(source_file, local_path)
+    prefetcher.close()
+
+    assert names == [f"f{i}.json.gz" for i in range(6)]
+
+
+def test_files_fetched_ahead_are_limited_to_window(source_dir):
+    source = RecordingSource(source_dir)
+    prefetcher = Prefetcher(source, source.list_files(), 2)
+    files = iter(prefetcher)
+
+    first = next(files)
+    time.sleep(0.2)
+    # Next file is fetched, none after it until first one is released
+    assert source.held == {"f0.json.gz", "f1.json.gz"}
+
+    prefetcher.release(*first)
+    for source_file, local_path in files:
+        prefetcher.release(source_file, local_path)
+    prefetcher.close()
+    assert source.max_held == 2
+    assert source.held == set()
+
+
+def test_downloaded_files_are_removed(source_dir, tmp_path_factory, monkeypatch):
+    monkeypatch.setattr(aws_wrapper, "s3_list", lambda s3_dir, endpoint_url=None: [
+        (name, os.path.getsize(os.path.join(source_dir, name))) for name in sorted(os.listdir(source_dir))
+    ])
+    monkeypatch.setattr(aws_wrapper, "s3_copy_file", lambda s3_path, local_path, endpoint_url=None: shutil.copy(
+        os.path.join(source_dir, os.path.basename(s3_path)), local_path
+    ))
+    source = S3Source("s3://bucket/events/")
+    prefetcher = Prefetcher(source, source.list_files(), 2)
+    for source_file, local_path in prefetcher:
+        assert os.path.dirname(local_path) == source.local_dir
+        assert os.path.isfile(local_path)
+        prefetcher.release(source_file, local_path)
+        assert not os.path.exists(local_path)
+    prefetcher.close()
+    source.close()
+
+    assert not os.path.exists(source.local_dir)
+    assert source.location() == "s3://bucket/events"
+
+
+def test_fetch_errors_are_raised_when_their_file_is_reached(source_dir):
+    source = RecordingSource(source_dir, failing_name="f2.json.gz")
+    prefetcher = Prefetcher(source, source.list_files(), 2)
+    names = []
+    with pytest.raises(IOError, match="f2.json.gz"):
+        for source_file, local_path in prefetcher:
+            names.append(source_file.name)
+            prefetcher.release(source_file, local_path)
+    prefetcher.close()
+
+    assert names == ["f0.json.gz", "f1.json.gz"]
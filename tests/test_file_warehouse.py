@@ -0,0 +1,67 @@
+import datetime
+import glob
+import os
+
+import pandas as pd
+from clickhouse_driver.bufferedreader import BufferedSocketReader
+from clickhouse_driver.streams.native import BlockInputStream
+
+from seghouse.config.data_type import DataType
+from seghouse.warehouse.file_warehouse import NATIVE_BUFFER_SIZE, FileWarehouse
+
+TRACKS = {
+    "message_id": DataType.STRING,
+    "timestamp": DataType.DATETIME,
+    "count": DataType.INT64,
+    "price": DataType.FLOAT64,
+    "tags": DataType.ARRAY,
+    "context": DataType.MAP,
+    "name": DataType.STRING,
+}
+
+
+class FileReaderSocket:
+    """Lets clickhouse_driver read blocks, which it receives over sockets, from a file"""
+
+    def __init__(self, file):
+        self.file = file
+
+    def recv_into(self, buffer, *args):
+        return self.file.readinto(buffer)
+
+
+def test_native_file_is_read_back_by_clickhouse_driver(tmp_path):
+    warehouse = FileWarehouse({"type": "file", "directory": str(tmp_path)})
+    warehouse.create_table("app", "tracks", TRACKS, ["message_id", "timestamp"], ["name"])
+    timestamp = pd.Timestamp("2021-01-01 00:00:01", tz="UTC")
+    df = pd.DataFrame({
+        "message_id": ["m1", "m2"],
+        "timestamp": [timestamp, timestamp],
+        "count": pd.Series([1, None], dtype=object),
+        "price": [1.5, 2.0],
+        "tags": [["a", "b"], []],
+        "context": [{"os": "ios"}, {}],
+        "name": ["x", None],
+    })
+    warehouse.insert_df("app", "tracks", df, TRACKS)
+
+    file_path, = glob.glob(os.path.join(str(tmp_path), "app", "tracks", "*.native"))
+    with open(file_path, "rb") as f:
+        reader = BufferedSocketReader(FileReaderSocket(f), NATIVE_BUFFER_SIZE)
+        block = BlockInputStream(reader, warehouse.native_context).read()
+
+    assert block.columns_with_types == [
+        ("message_id", "String"),
+        ("timestamp", "DateTime"),
+        ("count", "Nullable(Int64)"),
+        ("price", "Nullable(Float64)"),
+        ("tags", "Array(Nullable(String))"),
+        ("context", "Map(String, String)"),
+        ("name", "LowCardinality(Nullable(String))"),
+    ]
+    # Datetimes are read back as naive UTC, like from a ClickHouse server in UTC
+    written_at = datetime.datetime(2021, 1, 1, 0, 0, 1)
+    assert block.get_rows() == [
+        ("m1", written_at, 1, 1.5, ["a", "b"], {"os": "ios"}, "x"),
+        ("m2", written_at, None, 2.0, [], {}, None),
+    ]
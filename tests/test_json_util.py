@@ -0,0 +1,59 @@
+import json
+
+import humps
+import pytest
+
+from seghouse.util import json_util
+
+LINES = [
+    b'{"a": 1, "id": "12345678901234567890"}\n',
+    b'{"a": 123456789012345678901234567890, "b": [-92233720368547758090]}\n',
+    b'{"f": 0.12345678901234567890123, "n": NaN}\n',
+]
+
+
+@pytest.mark.parametrize("backend", json_util.JSON_BACKENDS)
+def test_loads_lines_keeps_wide_integers(backend):
+    try:
+        loads = json_util.get_loads(backend)
+    except Exception as e:
+        pytest.skip(repr(e))
+
+    assert json_util.loads_lines(LINES, loads) == [json.loads(line) for line in LINES]
+    assert [json_util.loads_line(line, loads) for line in LINES] == [json.loads(line) for line in LINES]
+
+
+EVENTS = {
+    "camel case": {"anonymousId": "a1", "context": {"userAgent": "ua", "os": {"osName": "ios"}}},
+    "acronyms": {"userID": 1, "HTMLParser": 2, "context": {"URLPath": "/", "pageURL": "u", "IPAddress": None}},
+    "digits": {"utm2Source": "s", "page1": 1, "v2Event": {"x10Y": True}, "1st": 0},
+    "nested lists": {"products": [{"skuId": "a", "tags": ["x", {"tagName": "y"}]}, [1, [2]]]},
+    "empty objects": {"traits": {}, "items": [], "context": {"app": {}, "list": [{}]}, "name": ""},
+    "odd keys": {"order id": 1, "event:type": "t", "page-name": "p", " padded ": 2, "ünïcode": 3},
+}
+
+
+@pytest.mark.parametrize("event", EVENTS.values(), ids=EVENTS.keys())
+def test_flatten_event_matches_flatten_json_of_decamelized_event(event):
+    expected = json_util.flatten_json(humps.decamelize(event))
+    flattened = json_util.flatten_event(event)
+    assert flattened == expected
+    assert list(flattened) == list(expected)
+
+
+def test_missing_backend_fails_with_install_hint(monkeypatch):
+    real_import = json_util.importlib.import_module
+
+    def import_module(name):
+        if name == "orjson":
+            raise ImportError("No module named 'orjson'")
+        return real_import(name)
+
+    monkeypatch.setattr(json_util.importlib, "import_module", import_module)
+    json_util.get_loads.cache_clear()
+    try:
+        with pytest.raises(Exception, match=r"pip install 'seghouse\[orjson\]'"):
+            json_util.get_loads("orjson")
+        assert json_util.get_loads("auto") is json.loads
+    finally:
+        json_util.get_loads.cache_clear()
@@ -0,0 +1,44 @@
+import sqlite3
+
+from seghouse.util.file_source import LocalDirSource
+from seghouse.util.manifest import IngestManifest
+
+
+def test_same_file_name_of_two_directories_is_sent_from_both(tmp_path):
+    sources = []
+    for directory in ("a", "b"):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "events.gz").write_bytes(b"same size")
+        sources.append(LocalDirSource(str(tmp_path / directory)))
+    manifest = IngestManifest(str(tmp_path / "manifest.db"))
+
+    first, second = sources
+    source_file, = first.list_files()
+    assert second.list_files() == [source_file]
+    manifest.record("app", first.location(), source_file, "md5", {"tracks": 1})
+
+    assert manifest.contains("app", first.location(), source_file)
+    assert not manifest.contains("app", second.location(), source_file)
+    assert not manifest.contains("other_app", first.location(), source_file)
+    manifest.close()
+
+
+def test_files_recorded_without_location_match_any_location(tmp_path):
+    file_path = str(tmp_path / "manifest.db")
+    connection = sqlite3.connect(file_path)
+    connection.execute(
+        "CREATE TABLE ingested_files (namespace TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, "
+        "checksum TEXT NOT NULL, rows TEXT NOT NULL, ingested_at TEXT NOT NULL, PRIMARY KEY (namespace, name, size))"
+    )
+    connection.execute("INSERT INTO ingested_files VALUES ('app', 'events.gz', 9, 'md5', '{}', 'then')")
+    connection.commit()
+    connection.close()
+
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "events.gz").write_bytes(b"same size")
+    source = LocalDirSource(str(tmp_path / "a"))
+    source_file, = source.list_files()
+
+    manifest = IngestManifest(file_path)
+    assert manifest.contains("app", source.location(), source_file)
+    manifest.close()
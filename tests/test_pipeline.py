@@ -0,0 +1,169 @@
+import threading
+import time
+
+import pytest
+
+from seghouse.jobs import pipeline
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_read_ahead_produces_at_most_queue_size_items_ahead():
+    produced = []
+
+    def items():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    reader = pipeline.ReadAhead(items(), 2, "test-reader")
+    consumed = iter(reader)
+    assert next(consumed) == 0
+    time.sleep(0.2)
+    # 2 items wait in queue and producer is blocked putting next one
+    assert produced == [0, 1, 2, 3]
+
+    assert list(consumed) == list(range(1, 10))
+    reader.close()
+
+
+def test_read_ahead_raises_errors_of_producer_in_consumer():
+    def items():
+        yield 1
+        raise ValueError("unreadable")
+
+    with pytest.raises(ValueError, match="unreadable"):
+        list(pipeline.ReadAhead(items(), 2, "test-reader"))
+
+
+def test_read_ahead_producer_stops_once_consumer_fails():
+    def items():
+        i = 0
+        while True:
+            yield i
+            i += 1
+
+    reader = pipeline.ReadAhead(items(), 1, "test-reader")
+    with pytest.raises(RuntimeError):
+        for item in reader:
+            if item == 3:
+                raise RuntimeError("transform failed")
+    reader.close()
+    reader.thread.join(timeout=5)
+    assert not reader.thread.is_alive()
+
+
+def test_stage_submit_blocks_while_queue_is_full():
+    release = threading.Event()
+    calls = []
+
+    def call(i):
+        release.wait()
+        calls.append(i)
+
+    stage = pipeline.Stage("test-writer", 1)
+    stage.submit(call, 0)
+    wait_until(lambda: stage.calls.empty())
+    stage.submit(call, 1)
+    blocked = threading.Thread(target=stage.submit, args=(call, 2))
+    blocked.start()
+    time.sleep(0.2)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join(timeout=5)
+    stage.close()
+    assert calls == [0, 1, 2]
+
+
+def test_stage_error_is_raised_by_next_submit_or_close():
+    def fail():
+        raise IOError("insert failed")
+
+    stage = pipeline.Stage("test-writer", 2)
+    stage.submit(fail)
+    wait_until(lambda: stage.error is not None)
+    with pytest.raises(IOError, match="insert failed"):
+        stage.submit(print)
+    with pytest.raises(IOError, match="insert failed"):
+        stage.close()
+
+
+def test_stage_abort_drops_and_returns_queued_calls():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def call(i):
+        started.set()
+        release.wait()
+        calls.append(i)
+
+    stage = pipeline.Stage("test-writer", 3)
+    stage.submit(call, 0)
+    started.wait(timeout=5)
+    stage.submit(call, 1)
+    stage.submit(call, 2)
+
+    dropped = []
+    aborting = threading.Thread(target=lambda: dropped.extend(stage.abort()))
+    aborting.start()
+    wait_until(stage.stopped.is_set)
+    release.set()
+    aborting.join(timeout=5)
+
+    assert calls == [0]
+    assert dropped == [(call, (1,)), (call, (2,))]
+
+
+def test_stage_without_queue_runs_calls_in_caller_thread():
+    threads = []
+    stage = pipeline.Stage("test-writer", 0, after=lambda: threads.append(threading.current_thread()))
+    stage.submit(threads.append, threading.current_thread())
+    stage.close()
+    assert threads == [threading.current_thread()] * 2
+
+
+def test_fan_out_records_failures_of_a_target_while_other_targets_go_on():
+    inserted = []
+
+    def insert(target, rows):
+        if target == "broken":
+            raise IOError(f"{target} is down")
+        inserted.append((target, rows))
+
+    fan_out = pipeline.FanOut({"ok": 1, "broken": 1})
+    for target in ("ok", "broken"):
+        fan_out.submit(target, "tracks", {"f1"}, insert, target, 1)
+    fan_out.submit("ok", "tracks", {"f2"}, insert, "ok", 2)
+    fan_out.wait()
+    fan_out.close()
+
+    assert inserted == [("ok", 1), ("ok", 2)]
+    assert [(f.target, f.name) for f in fan_out.failures] == [("broken", "tracks")]
+    assert fan_out.failed_sources == {"f1"}
+    assert fan_out.pending_sources() == set()
+
+
+def test_fan_out_blocks_submit_once_twice_limit_calls_are_in_flight():
+    release = threading.Event()
+    fan_out = pipeline.FanOut({"slow": 1})
+    for source in ("f1", "f2"):
+        fan_out.submit("slow", "tracks", {source}, release.wait)
+    assert fan_out.pending_sources() == {"f1", "f2"}
+
+    blocked = threading.Thread(target=fan_out.submit, args=("slow", "tracks", {"f3"}, release.wait))
+    blocked.start()
+    time.sleep(0.2)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join(timeout=5)
+    fan_out.wait()
+    fan_out.close()
+    assert fan_out.pending_sources() == set()
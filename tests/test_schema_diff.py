@@ -0,0 +1,45 @@
+import pandas as pd
+
+from seghouse.config.configuration import LowCardinality
+from seghouse.warehouse.schema_diff import LowCardinalityColumns
+
+
+def columns(conf, **values):
+    return LowCardinalityColumns(conf, pd.DataFrame(values))
+
+
+def test_columns_with_few_distinct_values_are_low_cardinality():
+    conf = LowCardinality(max_ratio=0.1, min_values=100, max_distinct=3)
+    batch = columns(
+        conf,
+        os=["ios", "android"] * 50,
+        user_id=[f"u{i}" for i in range(100)],
+        version=[f"1.{i % 4}" for i in range(100)],
+        channel=["client", None] * 50,
+    )
+    assert "os" in batch
+    # Too many distinct values for ratio and for max_distinct
+    assert "user_id" not in batch
+    assert "version" not in batch
+    # Nulls are not values
+    assert "channel" not in batch
+    assert "missing" not in batch
+
+
+def test_listed_and_excluded_columns_win_over_detection():
+    conf = LowCardinality(columns=frozenset(["user_id"]), excluded_columns=frozenset(["os"]), max_ratio=0.1,
+                          min_values=10)
+    batch = columns(conf, os=["ios"] * 10, user_id=[f"u{i}" for i in range(10)])
+    assert "user_id" in batch
+    assert "os" not in batch
+
+
+def test_detection_is_off_without_max_ratio():
+    assert "os" not in columns(LowCardinality(min_values=1), os=["ios"] * 10)
+
+
+def test_only_batch_creating_column_is_counted():
+    conf = LowCardinality(max_ratio=0.5, min_values=10)
+    # Each batch decides on its own, a small first batch does not make the column low cardinality
+    assert "os" not in columns(conf, os=["ios"] * 5)
+    assert "os" in columns(conf, os=["ios"] * 10)
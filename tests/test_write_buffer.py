@@ -0,0 +1,45 @@
+import pandas as pd
+
+from seghouse.config.data_type import DataType
+from seghouse.jobs.write_buffer import WriteBuffer
+from seghouse.util import dataframe_util
+from seghouse.util.dataframe_util import TypedFrame
+
+
+def frame(rows, **col_types):
+    df = pd.DataFrame({column: ["x" * 100] * rows for column in col_types})
+    return TypedFrame(df, dict(col_types))
+
+
+def test_largest_tables_are_flushed_over_max_bytes():
+    written = []
+    buffer = WriteBuffer(lambda table, f, sources, checks: written.append(table), flush_rows=10 ** 6)
+    small, large = frame(1, a=DataType.STRING), frame(50, a=DataType.STRING)
+    buffer.max_bytes = dataframe_util.estimate_memory(small.df) + dataframe_util.estimate_memory(large.df)
+
+    buffer.add("small", small)
+    buffer.add("large", large)
+    assert written == []
+
+    buffer.add("small", small)
+    assert written == ["large"]
+    assert list(buffer.tables) == ["small"]
+    assert buffer.buffered_bytes() <= buffer.max_bytes
+
+
+def test_table_checks_get_merged_column_types_and_frames_are_released():
+    written = []
+    buffer = WriteBuffer(lambda table, f, sources, checks: written.append((f, sources, checks)), flush_rows=3)
+
+    def check(name, warehouse, typed_frame):
+        pass
+
+    buffer.add("t", frame(1, a=DataType.STRING), "f1", check)
+    table_buffer = buffer.tables["t"]
+    buffer.add("t", frame(2, a=DataType.INT64, b=DataType.FLOAT64), "f2", check)
+
+    (written_frame, sources, checks), = written
+    assert dataframe_util.row_count(written_frame.df) == 3
+    assert sources == {"f1", "f2"}
+    assert checks == {check: {"a": DataType.STRING, "b": DataType.FLOAT64}}
+    assert table_buffer.frames == []